@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import gc
+from argparse import ArgumentParser
+from random import seed as set_seed
+from time import time
+
+from chroma_wanderer import random_colors, color_episodes, episode_edges
+from color import closest_color_indices
+from rdfwrap import NXRDF
+
+def build_by_edge(colors, num_labels):
+    # the edge-at-a-time construction color_episodes used before add_edges
+    graph = NXRDF()
+    labels = closest_color_indices(colors, num_labels)
+    nodes = [graph.add_node() for _ in colors]
+    for parent, label, child in episode_edges(nodes, colors, labels):
+        graph.add_edge(parent, label, child)
+    return graph
+
+def build_in_bulk(colors, num_labels):
+    return color_episodes(colors, num_labels, NXRDF())
+
+def build_in_bulk_with_rdflib(colors, num_labels):
+    # add_edges defers loading rdflib until it is needed; force it here
+    graph = build_in_bulk(colors, num_labels)
+    graph.rdf
+    return graph
+
+def main():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--num-episodes', type=int, default=100000, help='number of episodes to build')
+    arg_parser.add_argument('--num-labels', type=int, default=50, help='number of color labels')
+    arg_parser.add_argument('--seed', type=int, default=8675309, help='random seed for the colors')
+    args = arg_parser.parse_args()
+
+    set_seed(args.seed)
+    colors = random_colors(args.num_episodes)
+    runtimes = {}
+    builders = (
+        ('by-edge', build_by_edge),
+        ('bulk', build_in_bulk),
+        ('bulk+rdflib', build_in_bulk_with_rdflib),
+    )
+    for name, build in builders:
+        start_time = time()
+        graph = build(colors, args.num_labels)
+        runtimes[name] = time() - start_time
+        print('{}\t{:.3f}s\t{} triples'.format(name, runtimes[name], len(graph.rdf)))
+        # free the previous graph now so collecting it is not timed in the next build
+        del graph
+        gc.collect()
+    # by-edge always loads rdflib, so only bulk+rdflib compares like with like;
+    # bulk applies only while no query or caller needs the rdflib graph
+    print('speedup (bulk, rdflib load deferred)\t{:.2f}x'.format(runtimes['by-edge'] / runtimes['bulk']))
+    print('speedup (bulk+rdflib, rdflib loaded)\t{:.2f}x'.format(runtimes['by-edge'] / runtimes['bulk+rdflib']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from random import seed as set_seed
+from time import time
+
+from chroma_wanderer import random_walk, random_walk_array, color_episodes
+from episodes import EpisodeStore
+
+def walk_by_step(num_episodes):
+    # the Color-by-Color walk that random_walk builds with step
+    return random_walk(num_episodes)
+
+def walk_exact(num_episodes):
+    return random_walk_array(num_episodes)
+
+def walk_fast(num_episodes):
+    return random_walk_array(num_episodes, mode='fast')
+
+def main():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--num-episodes', type=int, nargs='+', default=[1000, 10000, 100000], help='numbers of episodes to sweep')
+    arg_parser.add_argument('--num-labels', type=int, default=50, help='number of color labels')
+    arg_parser.add_argument('--num-seeds', type=int, default=5, help='number of random seeds to sweep')
+    args = arg_parser.parse_args()
+
+    walkers = (
+        ('by-step', walk_by_step),
+        ('exact', walk_exact),
+        ('fast', walk_fast),
+    )
+    walk_times = dict((name, 0) for name, _ in walkers)
+    build_times = dict((name, 0) for name, _ in walkers)
+    print('episodes\twalker\twalk\twalk+build')
+    for num_episodes in args.num_episodes:
+        for name, walk in walkers:
+            walk_time = 0
+            build_time = 0
+            for seed in range(args.num_seeds):
+                set_seed(seed)
+                start_time = time()
+                colors = walk(num_episodes)
+                walk_time += time() - start_time
+                start_time = time()
+                color_episodes(colors, args.num_labels, EpisodeStore())
+                build_time += time() - start_time
+            walk_times[name] += walk_time
+            build_times[name] += walk_time + build_time
+            print('{}\t{}\t{:.3f}s\t{:.3f}s'.format(num_episodes, name, walk_time, walk_time + build_time))
+    for name in ('exact', 'fast'):
+        print('speedup ({})\t{:.2f}x walk\t{:.2f}x walk+build'.format(
+            name,
+            walk_times['by-step'] / walk_times[name],
+            build_times['by-step'] / build_times[name],
+        ))
+
+if __name__ == '__main__':
+    main()
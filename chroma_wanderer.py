@@ -1,7 +1,17 @@
-from random import randrange, seed as set_seed
+from array import array
+from itertools import count, islice
+from operator import length_hint
+from random import getrandbits, getstate, randrange, seed as set_seed, setstate
 
-from color import Color, closest_color
+import numpy as np
+
+from color import COLOR_CACHE, Color, IncrementalLabeler, array_to_colors, closest_color_indices
 from rdfwrap import NXRDF
+from timing import register as register_timing, span, timed
+
+CHUNK_SIZE = 65536
+
+register_timing('generate', 'insert')
 
 def step(color, max_dist=8):
     rand = randrange(3)
@@ -22,54 +32,242 @@ def step(color, max_dist=8):
         return Color(color.r, color.g, new_primary)
 
 def random_walk(n, start=None, seed=None):
+    return list(iter_random_walk(n, start=start, seed=seed))
+
+def iter_random_walk(n, start=None, seed=None):
     if seed is not None:
         set_seed(seed)
     if start is None:
         cur_color = Color(randrange(256), randrange(256), randrange(256))
     else:
         cur_color = start
-    result = []
     for i in range(n):
-        result.append(cur_color)
+        yield cur_color
         cur_color = step(cur_color)
+
+def random_walk_array(n, start=None, seed=None, mode='exact', max_dist=8):
+    # in exact mode, the Nx3 array of the colors random_walk would return; in
+    # fast mode, a walk with the same distribution from a numpy generator
+    # seeded by the global one
+    assert mode in ('exact', 'fast'), 'unknown walk mode: {}'.format(mode)
+    if seed is not None:
+        set_seed(seed)
+    if start is None:
+        start = Color(randrange(256), randrange(256), randrange(256))
+    start = (start.r, start.g, start.b)
+    if mode == 'exact':
+        return exact_walk_array(n, start, max_dist)
+    return fast_walk_array(n, start, max_dist, np.random.default_rng(getrandbits(64)))
+
+@timed('generate')
+def exact_walk_array(n, start, max_dist=8):
+    # replays the draws of step directly on the outputs of the generator,
+    # without calling randrange or creating colors
+    width = 2 * max_dist + 1
+    channel_shift = 32 - (3).bit_length()
+    delta_shift = 32 - width.bit_length()
+    words = RandomWords()
+    draw = iter(words).__next__
+    result = array('h')
+    color = list(start)
+    for i in range(n):
+        result.extend(color)
+        channel = draw() >> channel_shift
+        while channel >= 3:
+            channel = draw() >> channel_shift
+        while True:
+            delta = draw() >> delta_shift
+            while delta >= width:
+                delta = draw() >> delta_shift
+            value = color[channel] + delta - max_dist
+            if 0 <= value <= 255:
+                break
+        color[channel] = value
+    words.close()
+    return np.frombuffer(result, dtype=np.int16).reshape(n, 3).copy()
+
+@timed('generate')
+def fast_walk_array(n, start, max_dist=8, rng=None, chunk_size=256):
+    # the channels of a walk only interact through which channel each step
+    # moves, so each channel is walked separately as a chunked cumulative sum;
+    # a step that would leave [0, 255] is redrawn uniformly from the deltas
+    # that stay inside, which is the distribution the rejection loop of step
+    # produces
+    if rng is None:
+        rng = np.random.default_rng()
+    result = np.empty((n, 3), dtype=np.int16)
+    if n == 0:
+        return result
+    channels = rng.integers(3, size=n - 1)
+    for channel in range(3):
+        deltas = rng.integers(-max_dist, max_dist + 1, size=np.count_nonzero(channels == channel))
+        values = np.empty(len(deltas) + 1, dtype=np.int64)
+        values[0] = start[channel]
+        i = 0
+        while i < len(deltas):
+            walk = values[i] + np.cumsum(deltas[i:i + chunk_size])
+            outside = np.flatnonzero((walk < 0) | (walk > 255))
+            if len(outside) == 0:
+                values[i + 1:i + 1 + len(walk)] = walk
+                i += len(walk)
+                continue
+            bad = outside[0]
+            values[i + 1:i + 1 + bad] = walk[:bad]
+            i += bad
+            current = values[i]
+            values[i + 1] = current + rng.integers(max(-max_dist, -current), min(max_dist, 255 - current) + 1)
+            i += 1
+        # the number of steps of this channel before each color
+        steps = np.zeros(n, dtype=np.int64)
+        np.cumsum(channels == channel, out=steps[1:])
+        result[:, channel] = values[steps]
     return result
 
+class RandomWords:
+    # the outputs of the global generator, drawn in chunks; close rewinds the
+    # generator to just after the last output that was iterated over
+    def __init__(self, chunk_size=4096):
+        self.chunk_size = chunk_size
+        self.words = []
+        self.chunk = iter(self.words)
+        self.state = None
+    def __iter__(self):
+        while True:
+            self.state = getstate()
+            self.words = random_words(self.chunk_size).tolist()
+            self.chunk = iter(self.words)
+            yield from self.chunk
+    def close(self):
+        if self.state is not None:
+            setstate(self.state)
+            random_words(len(self.words) - length_hint(self.chunk))
+        self.words = []
+        self.chunk = iter(self.words)
+        self.state = None
+
 def random_colors(n, seed=None):
+    return list(iter_random_colors(n, seed=seed))
+
+def iter_random_colors(n, seed=None, chunk_size=CHUNK_SIZE):
+    # colors are drawn chunk_size at a time, so other calls to the global
+    # generator while iterating would change the sequence
     if seed is not None:
         set_seed(seed)
-    result = []
-    for i in range(n):
-        result.append(Color(randrange(256), randrange(256), randrange(256)))
+    for start in range(0, n, chunk_size):
+        yield from array_to_colors(random_color_array(min(chunk_size, n - start)))
+
+def random_color_array(n, seed=None):
+    # an Nx3 array of the colors random_colors would return
+    if seed is not None:
+        set_seed(seed)
+    return random_below_array(3 * n, 256).astype(np.int16).reshape(n, 3)
+
+def random_words(n):
+    # the next n outputs of the global Mersenne Twister, as n calls to
+    # getrandbits(32) would return them
+    if n == 0:
+        return np.empty(0, dtype=np.uint32)
+    return np.frombuffer(getrandbits(32 * n).to_bytes(4 * n, 'little'), dtype=np.uint32)
+
+@timed('generate')
+def random_below_array(n, bound, max_words=2**20):
+    # the values [randrange(bound) for _ in range(n)] would return; each attempt
+    # of randrange takes the top bound.bit_length() bits of one output and
+    # rejects values >= bound, so attempts are drawn in bulk and the generator
+    # is then rewound to just after the last attempt that was needed
+    bits = bound.bit_length()
+    result = np.empty(n, dtype=np.int64)
+    filled = 0
+    while filled < n:
+        needed = n - filled
+        state = getstate()
+        words = random_words(min(max_words, (needed << bits) // bound + needed // 8 + 64))
+        values = words >> (32 - bits)
+        accepted = np.flatnonzero(values < bound)
+        if len(accepted) >= needed:
+            accepted = accepted[:needed]
+            setstate(state)
+            random_words(int(accepted[-1]) + 1)
+        result[filled:filled + len(accepted)] = values[accepted]
+        filled += len(accepted)
     return result
 
-def color_episodes(colors, num_labels, graph=None, start_time=0):
+def color_episodes(colors, num_labels, graph=None, start_time=0, chunk_size=CHUNK_SIZE):
+    # colors may be any iterable of colors, which is consumed chunk_size colors
+    # at a time, or an Nx3 array
     if graph is None:
         graph = NXRDF()
-    for time, color in enumerate(colors, start=start_time):
-        node = graph.add_node()
-        graph.add_edge(node, 'episode', time)
-        graph.add_edge(node, 'color_code', color)
-        graph.add_edge(node, 'color_name', closest_color(color, num_labels).name)
-        graph.add_edge(node, 'red', color.r)
-        graph.add_edge(node, 'green', color.g)
-        graph.add_edge(node, 'blue', color.b)
-        graph.add_edge(node, 'type', 'color')
+    for chunk in color_chunks(colors, chunk_size):
+        labels = closest_color_indices(chunk, num_labels)
+        with span('insert'):
+            nodes = graph.add_nodes(len(chunk))
+            graph.add_edges(episode_edges(nodes, chunk, labels, start_time))
+        start_time += len(chunk)
     return graph
 
-def color_episodes_with_changes(colors, changes):
+def color_chunks(colors, chunk_size=CHUNK_SIZE):
+    if isinstance(colors, np.ndarray):
+        for start in range(0, len(colors), chunk_size):
+            yield array_to_colors(colors[start:start + chunk_size])
+        return
+    colors = iter(colors)
+    chunk = list(islice(colors, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(colors, chunk_size))
+
+def episode_edges(nodes, colors, labels, start_time=0):
+    for node, time, color, label in zip(nodes, count(start_time), colors, labels):
+        yield node, 'episode', time
+        yield node, 'color_code', color
+        yield node, 'color_name', COLOR_CACHE[label].name
+        yield node, 'red', color.r
+        yield node, 'green', color.g
+        yield node, 'blue', color.b
+        yield node, 'type', 'color'
+
+def color_episodes_with_changes(colors, changes, graph=None, chunk_size=CHUNK_SIZE):
     # changes is a list of [time, num_label] pairs; for example
     # changes = [
     #     [0, 10],  # start with 10 labels
     #     [17, 11], # at time 17, use 11 labels
     #     [60, 12], # at time 60, use 12 labels
     # ]
-    graph = NXRDF()
-    if changes[-1][0] < len(colors):
-        changes = changes + [[len(colors), changes[-1][1]]]
-    for [start, num_labels], [end, _] in zip(changes[:-1], changes[1:]):
-        graph = color_episodes(colors[start:end], num_labels, graph, start_time=start)
+    # colors may be an iterator, which is consumed chunk_size colors at a time;
+    # the last change lasts until the end of the colors
+    if graph is None:
+        graph = NXRDF()
+    start_time = changes[0][0]
+    for chunk in color_chunks(islice(color_iter(colors), start_time, None), chunk_size):
+        labels = changed_labels(chunk, changes, start_time)
+        with span('insert'):
+            nodes = graph.add_nodes(len(chunk))
+            graph.add_edges(episode_edges(nodes, chunk, labels, start_time))
+        start_time += len(chunk)
     return graph
 
+@timed('label')
+def changed_labels(colors, changes, start_time=0):
+    # labels the colors from start_time on with the number of labels in effect
+    # at each time; each change only relabels the colors after it
+    end_time = start_time + len(colors)
+    num_labels = changes[0][1]
+    later_changes = []
+    for time, change_labels in changes:
+        if time <= start_time:
+            num_labels = change_labels
+        elif time < end_time:
+            later_changes.append([time, change_labels])
+    labeler = IncrementalLabeler(colors, num_labels)
+    for time, num_labels in later_changes:
+        labeler.relabel(num_labels, time - start_time)
+    return labeler.labels
+
+def color_iter(colors):
+    if isinstance(colors, np.ndarray):
+        return (color for chunk in color_chunks(colors) for color in chunk)
+    return iter(colors)
+
 def main():
     changes = [
         [0, 1],
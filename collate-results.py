@@ -1,48 +1,157 @@
 #!/usr/bin/env python3
 
+import json
 import re
-from csv import DictReader, DictWriter
+from csv import reader as csv_reader, writer as csv_writer
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from shutil import copyfileobj
+
+import numpy as np
+
+def read_header(file):
+    # the columns and delimiter of a result file, from its first line; results
+    # are tab-separated unless they were written by CSVSink, and JSON lines
+    # (with a delimiter of None) if written by JSONLinesSink
+    with open(file, newline='') as fd:
+        line = fd.readline()
+    if file.endswith('.jsonl'):
+        return (list(json.loads(line).keys()) if line.strip() else []), None
+    delimiter = '\t' if '\t' in line else ','
+    return next(csv_reader([line], delimiter=delimiter)), delimiter
+
+def check_row(row, columns, file, line_number):
+    # a short row is usually the last line of a killed job
+    assert len(row) == len(columns), 'row has {} fields instead of {}: {} line {}'.format(len(row), len(columns), file, line_number)
+
+def read_rows(file, columns, delimiter):
+    # the rows of a result file, without its header, as lists of strings;
+    # JSON values are formatted as TSVSink would have written them
+    if delimiter is None:
+        with open(file) as fd:
+            for line_number, line in enumerate(fd, start=1):
+                row = [str(value) for value in json.loads(line).values()]
+                check_row(row, columns, file, line_number)
+                yield row
+    else:
+        with open(file, newline='') as fd:
+            rows = csv_reader(fd, delimiter=delimiter)
+            next(rows)
+            for row in rows:
+                check_row(row, columns, file, rows.line_num)
+                yield row
+
+def collate_csv(result_files, headers, fieldnames, output_file):
+    # the original collation: every row is parsed and rewritten comma-separated
+    with open(output_file, 'w') as out_fd:
+        writer = csv_writer(out_fd)
+        writer.writerow(fieldnames)
+        for file in result_files:
+            writer.writerows(read_rows(file, *headers[file]))
+
+def collate_stream(result_files, headers, fieldnames, output_file, block_size=2**20):
+    # files whose header is exactly the output columns are copied as raw blocks;
+    # any other file is parsed and its rows rearranged into the output columns,
+    # with empty values for columns it does not have
+    with open(output_file, 'wb') as out_fd:
+        out_fd.write(('\t'.join(fieldnames) + '\n').encode('utf-8'))
+        for file in result_files:
+            columns, delimiter = headers[file]
+            if columns == fieldnames and delimiter == '\t':
+                with open(file, 'rb') as in_fd:
+                    in_fd.readline()
+                    copyfileobj(in_fd, out_fd, block_size)
+                    if in_fd.tell() > 0:
+                        in_fd.seek(-1, 2)
+                        if in_fd.read(1) != b'\n':
+                            out_fd.write(b'\n')
+            else:
+                positions = [(columns.index(column) if column in columns else None) for column in fieldnames]
+                lines = []
+                for row in read_rows(file, columns, delimiter):
+                    lines.append('\t'.join((row[position] if position is not None else '') for position in positions) + '\n')
+                    if len(lines) >= 4096:
+                        out_fd.write(''.join(lines).encode('utf-8'))
+                        lines = []
+                out_fd.write(''.join(lines).encode('utf-8'))
+
+def read_columns(result_files, headers, fieldnames):
+    columns = dict((column, []) for column in fieldnames)
+    for file in result_files:
+        file_columns, delimiter = headers[file]
+        positions = [(file_columns.index(column) if column in file_columns else None) for column in fieldnames]
+        for row in read_rows(file, file_columns, delimiter):
+            for column, position in zip(fieldnames, positions):
+                columns[column].append(row[position] if position is not None else '')
+    return columns
+
+def column_array(values):
+    # the narrowest of int, float, and string arrays that holds the values;
+    # missing values make a numeric column float, with NaN for the missing
+    try:
+        return np.array([int(value) for value in values], dtype=np.int64)
+    except ValueError:
+        pass
+    try:
+        return np.array([(float(value) if value != '' else np.nan) for value in values], dtype=np.float64)
+    except ValueError:
+        return np.array(values, dtype=str)
+
+def write_npz(result_files, headers, fieldnames, output_file):
+    # one array per column, loadable with np.load; __columns__ keeps the order
+    columns = read_columns(result_files, headers, fieldnames)
+    arrays = dict((column, column_array(values)) for column, values in columns.items())
+    np.savez(output_file, __columns__=np.array(fieldnames, dtype=str), **arrays)
 
 def main():
-    arg_parser = ArgumentParser(usage='%(prog)s CSV ...')
-    arg_parser.add_argument('csvs', metavar='CSV', nargs='+', help='result files')
+    arg_parser = ArgumentParser(usage='%(prog)s [--stream] [--npz] RESULTS ...')
+    arg_parser.add_argument('csvs', metavar='RESULTS', nargs='+', help='result files, in any format the experiment sinks write')
+    arg_parser.add_argument('--stream', action='store_true', help='copy rows without parsing them into a tab-separated file, allowing files with different columns')
+    arg_parser.add_argument('--npz', action='store_true', help='also write the columns as NumPy arrays')
+    arg_parser.add_argument('--jobs', type=int, default=8, help='number of headers to read at once')
     args = arg_parser.parse_args()
 
     experiment_name = None
     latest = None
-    fieldnames = None
     result_files = []
 
     for file in args.csvs:
-        match = re.match(r'^(?P<experiment_name>[a-z0-9_-]*)-(?P<timestamp>[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9:.-]*)-results.csv$', file)
-        assert match, 'file does not conform to "<experiment>-<timestamp>-results.csv" naming: {}'.format(file)
+        match = re.match(r'^(?P<experiment_name>[a-z0-9_-]*)-(?P<timestamp>[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9:.-]*)-results\.(csv|comma\.csv|jsonl)$', file)
+        assert match, 'file does not conform to "<experiment>-<timestamp>-results.<csv|comma.csv|jsonl>" naming: {}'.format(file)
         date = datetime.strptime(match.group('timestamp'), '%Y-%m-%dT%H:%M:%S.%f')
         if experiment_name is None:
             experiment_name = match.group('experiment_name')
             latest = date
-            with open(file) as fd:
-                fieldnames = DictReader(fd, delimiter='\t').fieldnames
         else:
             assert experiment_name == match.group('experiment_name'), 'file has different experiment name: {}'.format(file)
             if latest < date:
                 latest = date
-            with open(file) as fd:
-                assert fieldnames == DictReader(fd, delimiter='\t').fieldnames, 'file has different fields: {}'.format(file)
         result_files.append(file)
 
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        headers = dict(zip(result_files, executor.map(read_header, result_files)))
+
+    fieldnames = None
+    for file in result_files:
+        columns, _ = headers[file]
+        if fieldnames is None:
+            fieldnames = list(columns)
+        elif args.stream:
+            # the union of the columns, in the order they are first seen
+            fieldnames.extend(column for column in columns if column not in fieldnames)
+        else:
+            assert fieldnames == columns, 'file has different fields: {}'.format(file)
+
     assert fieldnames is not None, 'could not determine field names'
 
-    output_file = '{}-{}-collated.csv'.format(experiment_name, latest.isoformat())
-    with open(output_file, 'w') as out_fd:
-        writer = DictWriter(out_fd, fieldnames=fieldnames)
-        writer.writeheader()
-        for file in result_files:
-            with open(file) as in_fd:
-                reader = DictReader(in_fd, delimiter='\t')
-                for row in reader:
-                    writer.writerow(row)
+    output_prefix = '{}-{}-collated'.format(experiment_name, latest.isoformat())
+    if args.stream:
+        collate_stream(result_files, headers, fieldnames, output_prefix + '.tsv')
+    else:
+        collate_csv(result_files, headers, fieldnames, output_prefix + '.csv')
+    if args.npz:
+        write_npz(result_files, headers, fieldnames, output_prefix + '.npz')
 
 if __name__ == '__main__':
     main()
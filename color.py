@@ -1,35 +1,73 @@
+from functools import lru_cache
+from heapq import heappush, heapreplace
+from operator import itemgetter
 from os.path import dirname, join as join_path, realpath
 
+import numpy as np
+
 from rdfwrap import NXRDF
+from timing import register as register_timing, timed
 
 DIRECTORY = dirname(realpath(__file__))
 
 COLOR_NAMES_FILE = join_path(DIRECTORY, 'color-centroids.tsv')
 
+register_timing('label')
+
 class Color:
+    # the channels are packed into one 24-bit integer, code, which is what
+    # colors compare on; colors also equal their hex strings, so they hash as
+    # their (cached) hex string
+    __slots__ = ('code', 'name', '_hex_')
     def __init__(self, r, g, b, name=None):
-        self.r = r
-        self.g = g
-        self.b = b
+        self.code = (int(r) << 16) | (int(g) << 8) | int(b)
         self.name = name
+        self._hex_ = None
+    @property
+    def r(self):
+        return self.code >> 16
+    @property
+    def g(self):
+        return (self.code >> 8) & 0xFF
+    @property
+    def b(self):
+        return self.code & 0xFF
     def __hash__(self):
         return hash(str(self))
     def __str__(self):
-        return '#{:02x}{:02x}{:02x}'.format(self.r, self.g, self.b).upper()
+        if self._hex_ is None:
+            self._hex_ = '#{:06X}'.format(self.code)
+        return self._hex_
     def __repr__(self):
         if self.name is not None:
             return 'Color({}, {}, {}, name={})'.format(self.r, self.g, self.b, repr(self.name))
         else:
             return 'Color({}, {}, {})'.format(self.r, self.g, self.b)
     def __eq__(self, other):
+        if isinstance(other, Color):
+            return self.code == other.code
+        # other objects, eg hex strings, compare by their string
         return str(self) == str(other)
     def __sub__(self, other):
-        return abs(self.r - other.r) + abs(self.g - other.g) + abs(self.b - other.b)
+        code = self.code
+        other_code = other.code
+        return (
+            abs((code >> 16) - (other_code >> 16))
+            + abs(((code >> 8) & 0xFF) - ((other_code >> 8) & 0xFF))
+            + abs((code & 0xFF) - (other_code & 0xFF))
+        )
     @staticmethod
     def from_hex(hexcode, name=None):
         if len(hexcode) == 7 and hexcode[0] == '#':
             hexcode = hexcode[1:]
         return Color(*(int(hexcode[i:i+2], 16) for i in range(0, 5, 2)), name=name)
+    @staticmethod
+    def from_code(code, name=None):
+        color = Color.__new__(Color)
+        color.code = int(code)
+        color.name = name
+        color._hex_ = None
+        return color
 
 def read_colors():
     colors = []
@@ -43,18 +81,116 @@ def read_colors():
             colors.append(Color.from_hex(hexcode, name))
     return colors
 
+def colors_to_array(colors):
+    if isinstance(colors, np.ndarray):
+        return colors.reshape(-1, 3).astype(np.int16)
+    return codes_to_array(colors_to_codes(colors))
+
+def colors_to_codes(colors):
+    return np.fromiter((color.code for color in colors), dtype=np.int32)
+
+def codes_to_array(codes):
+    codes = np.asarray(codes, dtype=np.int32)
+    return np.stack([codes >> 16, (codes >> 8) & 0xFF, codes & 0xFF], axis=1).astype(np.int16)
+
+def array_to_codes(array):
+    array = np.asarray(array, dtype=np.int32).reshape(-1, 3)
+    return (array[:, 0] << 16) | (array[:, 1] << 8) | array[:, 2]
+
+def array_to_colors(array):
+    return [Color.from_code(code) for code in array_to_codes(array).tolist()]
+
 COLOR_CACHE = read_colors()
+COLOR_ARRAY = colors_to_array(COLOR_CACHE)
+
+class ColorIndex:
+    # k-d tree over a list of colors under the Manhattan metric; ties between
+    # equidistant colors are broken by position in the list, as min and sorted do
+    LEAF_SIZE = 8
+    def __init__(self, colors):
+        self.colors = list(colors)
+        points = [(color.r, color.g, color.b, index) for index, color in enumerate(self.colors)]
+        self.root = self._build_(points)
+    def _build_(self, points):
+        lows = tuple(min((point[axis] for point in points), default=0) for axis in range(3))
+        highs = tuple(max((point[axis] for point in points), default=0) for axis in range(3))
+        if len(points) <= ColorIndex.LEAF_SIZE:
+            return (lows, highs, points, None, None)
+        axis = max(range(3), key=(lambda axis: highs[axis] - lows[axis]))
+        points = sorted(points, key=itemgetter(axis))
+        middle = len(points) // 2
+        return (lows, highs, None, self._build_(points[:middle]), self._build_(points[middle:]))
+    @staticmethod
+    def _box_distance_(node, r, g, b):
+        (low_r, low_g, low_b), (high_r, high_g, high_b) = node[0], node[1]
+        return (
+            max(0, low_r - r, r - high_r)
+            + max(0, low_g - g, g - high_g)
+            + max(0, low_b - b, b - high_b)
+        )
+    def _search_(self, node, r, g, b, k, exclude, heap):
+        # heap holds the best (-distance, -index) pairs found so far, worst first
+        _, _, points, left, right = node
+        if points is not None:
+            for point_r, point_g, point_b, index in points:
+                if exclude is not None and (point_r, point_g, point_b) == exclude:
+                    continue
+                item = (-(abs(point_r - r) + abs(point_g - g) + abs(point_b - b)), -index)
+                if len(heap) < k:
+                    heappush(heap, item)
+                elif item > heap[0]:
+                    heapreplace(heap, item)
+            return
+        children = sorted(
+            [(ColorIndex._box_distance_(child, r, g, b), child) for child in (left, right)],
+            key=itemgetter(0),
+        )
+        for bound, child in children:
+            if len(heap) == k and bound > -heap[0][0]:
+                break
+            self._search_(child, r, g, b, k, exclude, heap)
+    def knn(self, color, k, exclude_self=False):
+        # returns up to k [color, distance] pairs, nearest first; with
+        # exclude_self, colors equal to the query (by hexcode) are skipped
+        exclude = None
+        if exclude_self:
+            exclude = (color.r, color.g, color.b)
+        heap = []
+        if k > 0:
+            self._search_(self.root, color.r, color.g, color.b, k, exclude, heap)
+        return [[self.colors[-negative_index], -negative_distance] for negative_distance, negative_index in sorted(heap, reverse=True)]
+    def nearest(self, color):
+        neighbors = self.knn(color, 1)
+        if not neighbors:
+            raise ValueError('cannot find the nearest color in an empty index')
+        return neighbors[0][0]
+
+@lru_cache(maxsize=None)
+def get_color_index(num_colors):
+    return ColorIndex(COLOR_CACHE[:num_colors])
+
+@lru_cache(maxsize=32)
+def get_knn(num_colors, k):
+    # maps each color name to the names of its k nearest neighbors, nearest
+    # first; get_knn.cache_info() reports the cache hits and misses
+    index = get_color_index(num_colors)
+    return dict(
+        (color.name, tuple(neighbor.name for neighbor, _ in index.knn(color, k, exclude_self=True)))
+        for color in index.colors
+    )
+
+def neighbor_labels(name, num_colors, k):
+    return get_knn(num_colors, k).get(name, ())
 
 def create_knn_dot(num_colors, k):
     dot = []
     dot.append('digraph {')
     dot.append('  layout="neato"')
     dot.append('  overlap="scalexy"')
-    colors = COLOR_CACHE[:num_colors]
-    for color in colors:
+    index = get_color_index(num_colors)
+    for color in index.colors:
         dot.append('  "{hexcode}" [label="{name}\\n{hexcode}", style="filled", fillcolor="{hexcode}"]'.format(name=color.name, hexcode=str(color)))
-        neighbors = [[neighbor, color - neighbor] for neighbor in colors if neighbor != color]
-        neighbors = sorted(neighbors, key=(lambda kv: kv[1]))[:k]
+        neighbors = index.knn(color, k, exclude_self=True)
         for neighbor, distance in neighbors:
             dot.append('  "{}" -> "{}" [label="{}"]'.format(str(color), str(neighbor), distance))
     dot.append('}')
@@ -63,9 +199,9 @@ def create_knn_dot(num_colors, k):
 def create_knn(num_colors, k, graph=None):
     if graph is None:
         graph = NXRDF()
-    colors = COLOR_CACHE[:num_colors]
+    index = get_color_index(num_colors)
     node_map = {}
-    for color in colors:
+    for color in index.colors:
         color_node = graph.add_node()
         node_map[color] = color_node
         graph.add_edge(color_node, 'name', graph.add_literal(color.name))
@@ -73,15 +209,61 @@ def create_knn(num_colors, k, graph=None):
         graph.add_edge(color_node, 'r', graph.add_literal(color.r))
         graph.add_edge(color_node, 'g', graph.add_literal(color.g))
         graph.add_edge(color_node, 'b', graph.add_literal(color.b))
-    for color in colors:
-        neighbors = [[neighbor, color - neighbor] for neighbor in colors if neighbor != color]
-        neighbors = sorted(neighbors, key=(lambda kv: kv[1]))[:k]
+    for color in index.colors:
+        neighbors = index.knn(color, k, exclude_self=True)
         for neighbor, distance in neighbors:
             graph.add_edge(node_map[color], 'neighbor', node_map[neighbor])
     return graph
 
 def closest_color(color, num_colors):
-    return min(COLOR_CACHE[:num_colors], key=(lambda neighbor: neighbor - color))
+    return get_color_index(num_colors).nearest(color)
+
+@timed('label')
+def closest_color_indices(colors, num_colors, block_size=4096):
+    # vectorized closest_color over a sequence of colors (or an Nx3 array);
+    # argmin keeps the first of tied labels, as min does
+    colors = colors_to_array(colors)
+    centroids = COLOR_ARRAY[np.newaxis, :num_colors, :]
+    indices = np.empty(len(colors), dtype=np.intp)
+    for start in range(0, len(colors), block_size):
+        block = colors[start:start + block_size, np.newaxis, :]
+        indices[start:start + block_size] = np.abs(block - centroids).sum(axis=2).argmin(axis=1)
+    return indices
+
+class IncrementalLabeler:
+    # labels colors with their closest of the first num_labels colors, like
+    # closest_color_indices; growing the vocabulary only compares each new
+    # label with the current distance of each color
+    def __init__(self, colors, num_labels):
+        colors = colors_to_array(colors)
+        # contiguous channels, so each comparison is a few int16 vector operations
+        self.channels = [np.ascontiguousarray(colors[:, channel]) for channel in range(3)]
+        self.num_labels = num_labels
+        self.labels = closest_color_indices(colors, num_labels)
+        self.distances = self._distances_(self.channels, COLOR_ARRAY[self.labels].T)
+    @staticmethod
+    def _distances_(channels, centroid):
+        r, g, b = channels
+        distances = np.abs(r - centroid[0])
+        distances += np.abs(g - centroid[1])
+        distances += np.abs(b - centroid[2])
+        return distances
+    @timed('label')
+    def relabel(self, num_labels, start=0):
+        # relabels colors[start:] for num_labels labels; calls must not decrease
+        # start, and earlier colors keep their labels
+        channels = [channel[start:] for channel in self.channels]
+        labels = self.labels[start:]
+        distances = self.distances[start:]
+        if num_labels < self.num_labels:
+            labels[:] = closest_color_indices(np.stack(channels, axis=1), num_labels)
+            distances[:] = self._distances_(channels, COLOR_ARRAY[labels].T)
+        for label in range(self.num_labels, num_labels):
+            distance = self._distances_(channels, COLOR_ARRAY[label])
+            # a later label only wins strictly, as argmin keeps the first of ties
+            np.putmask(labels, distance < distances, label)
+            np.minimum(distances, distance, out=distances)
+        self.num_labels = num_labels
 
 def find_label_index(label):
     matching = [index for index, color in enumerate(COLOR_CACHE) if color.name.lower() == label.lower()]
@@ -0,0 +1,309 @@
+import json
+from array import array
+from bisect import insort
+from collections import OrderedDict
+from hashlib import sha1
+from os import environ, listdir, makedirs, rename, utime
+from os.path import exists, getsize, getmtime, join as join_path
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+
+class EpisodeStore:
+    # labels whose values are derivable (color_code from r/g/b) or constant (type)
+    IGNORED_LABELS = set(['color_code', 'type'])
+    # the columns and their numpy types, for saving and loading
+    COLUMNS = (
+        ('times', np.int64),
+        ('name_ids', np.int32),
+        ('reds', np.uint8),
+        ('greens', np.uint8),
+        ('blues', np.uint8),
+    )
+    def __init__(self):
+        self.times = array('q')
+        self.name_ids = array('i')
+        self.reds = array('B')
+        self.greens = array('B')
+        self.blues = array('B')
+        self.names = []
+        self.name_map = {}
+        # for each name id, the nodes with that name in time order
+        self.partitions = []
+        # the number of nodes whose time is after the next node's; node order is
+        # time order when there are none
+        self.num_descents = 0
+        self.time_sorted = True
+        # for each name, its nodes sorted by distance from the name's centroid
+        self.rings = {}
+    def __len__(self):
+        return len(self.times)
+    def add_edge(self, parent, label, child, **kwargs):
+        assert isinstance(parent, int)
+        assert isinstance(label, str)
+        if self.rings:
+            self.rings.clear()
+        if label == 'episode':
+            # times may be set in any node order, so both neighbors are rechecked
+            self.num_descents -= self._is_descent_(parent - 1) + self._is_descent_(parent)
+            self.times[parent] = child
+            self.num_descents += self._is_descent_(parent - 1) + self._is_descent_(parent)
+            self.time_sorted = (self.num_descents == 0)
+            if self.name_ids[parent] >= 0:
+                partition = self.partitions[self.name_ids[parent]]
+                partition.remove(parent)
+                self._partition_insert_(partition, parent)
+        elif label == 'color_name':
+            if self.name_ids[parent] >= 0:
+                self.partitions[self.name_ids[parent]].remove(parent)
+            name_id = self.add_name(child)
+            self.name_ids[parent] = name_id
+            self._partition_insert_(self.partitions[name_id], parent)
+        elif label == 'red':
+            self.reds[parent] = child
+        elif label == 'green':
+            self.greens[parent] = child
+        elif label == 'blue':
+            self.blues[parent] = child
+        elif label not in EpisodeStore.IGNORED_LABELS:
+            raise ValueError('unknown episode label: {}'.format(repr(label)))
+    def add_edges(self, edges, **kwargs):
+        for parent, label, child in edges:
+            self.add_edge(parent, label, child)
+    def add_node(self, **kwargs):
+        node = len(self.times)
+        if node > 0 and self.times[-1] > 0:
+            self.num_descents += 1
+            self.time_sorted = False
+        self.times.append(0)
+        self.name_ids.append(-1)
+        self.reds.append(0)
+        self.greens.append(0)
+        self.blues.append(0)
+        return node
+    def add_nodes(self, count, **kwargs):
+        return [self.add_node() for _ in range(count)]
+    def add_literal(self, value, **kwargs):
+        return value
+    def _is_descent_(self, node):
+        return 0 <= node < len(self.times) - 1 and self.times[node] > self.times[node + 1]
+    def add_name(self, name):
+        if name not in self.name_map:
+            self.name_map[name] = len(self.names)
+            self.names.append(name)
+            self.partitions.append(array('q'))
+        return self.name_map[name]
+    def _partition_insert_(self, partition, node):
+        if not partition or self.times[partition[-1]] <= self.times[node]:
+            partition.append(node)
+        else:
+            insort(partition, node, key=self.times.__getitem__)
+    def partition(self, name):
+        # the nodes labeled with name, in time order
+        if name in self.name_map:
+            return self.partitions[self.name_map[name]]
+        return array('q')
+    def ring(self, name, centroid):
+        # the nodes with name sorted by L1 distance from centroid (the color
+        # the name labels), and those distances; nodes at the same distance
+        # stay in time order
+        if name not in self.rings:
+            r, g, b = centroid.r, centroid.g, centroid.b
+            reds, greens, blues = self.reds, self.greens, self.blues
+            pairs = sorted(
+                ((abs(reds[node] - r) + abs(greens[node] - g) + abs(blues[node] - b)), position, node)
+                for position, node in enumerate(self.partition(name))
+            )
+            self.rings[name] = ([distance for distance, _, _ in pairs], [node for _, _, node in pairs])
+        return self.rings[name]
+    def time_order(self):
+        # the nodes in time order
+        if self.time_sorted:
+            return range(len(self.times))
+        return sorted(range(len(self.times)), key=self.times.__getitem__)
+    def nearest(self, targets, name=None, max_distance=3*255, tile_size=2**22):
+        # for each target in an Nx3 array, the node closest to it by L1 distance
+        # (only among nodes with name, if given), or -1 if none is closer than
+        # max_distance; ties go to the earliest node. Distances are computed for
+        # tiles of about tile_size target-node pairs at a time
+        targets = np.asarray(targets, dtype=np.int16).reshape(-1, 3)
+        if name is None:
+            nodes = np.array(self.time_order(), dtype=np.intp)
+        else:
+            nodes = np.array(self.partition(name), dtype=np.intp)
+        colors = [np.frombuffer(column, dtype=np.uint8).astype(np.int16)[nodes] for column in (self.reds, self.greens, self.blues)]
+        best_nodes = np.full(len(targets), -1, dtype=np.intp)
+        best_distances = np.full(len(targets), max_distance, dtype=np.int16)
+        if len(nodes) == 0:
+            return best_nodes
+        num_targets = max(1, min(len(targets), tile_size // len(nodes)))
+        num_nodes = max(1, tile_size // num_targets)
+        for target_start in range(0, len(targets), num_targets):
+            tile = targets[target_start:target_start + num_targets]
+            tile_distances = best_distances[target_start:target_start + num_targets]
+            tile_nodes = best_nodes[target_start:target_start + num_targets]
+            for node_start in range(0, len(nodes), num_nodes):
+                node_end = node_start + num_nodes
+                distances = np.abs(colors[0][np.newaxis, node_start:node_end] - tile[:, 0:1])
+                distances += np.abs(colors[1][np.newaxis, node_start:node_end] - tile[:, 1:2])
+                distances += np.abs(colors[2][np.newaxis, node_start:node_end] - tile[:, 2:3])
+                positions = distances.argmin(axis=1)
+                minimums = distances[np.arange(len(tile)), positions]
+                # earlier tiles hold earlier nodes, so only strictly closer nodes replace them
+                closer = minimums < tile_distances
+                tile_distances[closer] = minimums[closer]
+                tile_nodes[closer] = nodes[node_start + positions[closer]]
+        return best_nodes
+    def query_episodes(self, name=None):
+        # yields (time, name, r, g, b) rows in time order, like EXACT_LABEL_QUERY
+        if name is not None:
+            nodes = self.partition(name)
+        else:
+            nodes = self.time_order()
+        for node in nodes:
+            yield self._row_(node)
+    def save(self, directory):
+        # writes each column as a .npy file
+        makedirs(directory, exist_ok=True)
+        for column, dtype in EpisodeStore.COLUMNS:
+            np.save(join_path(directory, column + '.npy'), np.frombuffer(getattr(self, column), dtype=dtype))
+        offsets = [0]
+        for partition in self.partitions:
+            offsets.append(offsets[-1] + len(partition))
+        partition_nodes = array('q')
+        for partition in self.partitions:
+            partition_nodes.extend(partition)
+        np.save(join_path(directory, 'partition_nodes.npy'), np.frombuffer(partition_nodes, dtype=np.int64))
+        np.save(join_path(directory, 'partition_offsets.npy'), np.array(offsets, dtype=np.int64))
+        with open(join_path(directory, 'names.json'), 'w') as fd:
+            json.dump({'names': self.names, 'time_sorted': self.time_sorted}, fd)
+    @staticmethod
+    def load(directory):
+        # the columns are read into arrays rather than kept as numpy views, so
+        # that the store stays appendable and its values stay plain ints
+        store = EpisodeStore()
+        for column, dtype in EpisodeStore.COLUMNS:
+            getattr(store, column).frombytes(memoryview(np.load(join_path(directory, column + '.npy'))).cast('B'))
+        with open(join_path(directory, 'names.json')) as fd:
+            metadata = json.load(fd)
+        store.names = metadata['names']
+        store.name_map = dict((name, name_id) for name_id, name in enumerate(store.names))
+        times = np.frombuffer(store.times, dtype=np.int64)
+        store.num_descents = int(np.count_nonzero(times[:-1] > times[1:]))
+        store.time_sorted = (store.num_descents == 0)
+        partition_nodes = np.load(join_path(directory, 'partition_nodes.npy'))
+        offsets = np.load(join_path(directory, 'partition_offsets.npy'))
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            store.partitions.append(array('q', partition_nodes[start:end].tobytes()))
+        return store
+    def _row_(self, node):
+        name_id = self.name_ids[node]
+        return (
+            self.times[node],
+            (self.names[name_id] if name_id >= 0 else None),
+            self.reds[node],
+            self.greens[node],
+            self.blues[node],
+        )
+
+class EpisodeCache:
+    # built episode graphs, keyed by the parameters that generate them; the
+    # least recently used graphs are evicted to keep the graphs to at most
+    # max_episodes episodes in total, counting the graph being built
+    def __init__(self, max_episodes=100000):
+        self.max_episodes = max_episodes
+        self.graphs = OrderedDict()
+        self.num_episodes = 0
+        self.hits = 0
+        self.misses = 0
+    def __len__(self):
+        return len(self.graphs)
+    def __contains__(self, key):
+        return key in self.graphs
+    def get(self, key, num_episodes, build):
+        if key in self.graphs:
+            self.hits += 1
+            self.graphs.move_to_end(key)
+            return self.graphs[key][0]
+        self.misses += 1
+        # evicted before the build, so that they can be freed during it
+        self._evict_(max(0, self.max_episodes - num_episodes))
+        graph = build()
+        if num_episodes > self.max_episodes:
+            return graph
+        self.graphs[key] = (graph, num_episodes)
+        self.num_episodes += num_episodes
+        return graph
+    def _evict_(self, max_episodes):
+        while self.num_episodes > max_episodes:
+            _, (_, evicted_episodes) = self.graphs.popitem(last=False)
+            self.num_episodes -= evicted_episodes
+    def clear(self):
+        self.graphs.clear()
+        self.num_episodes = 0
+
+class DiskEpisodeCache:
+    # saved EpisodeStores, one directory per store, named by a hash of the
+    # generating key and the version of the code that built it; the least
+    # recently used stores are removed once the cache exceeds max_bytes
+    def __init__(self, directory, version='', max_bytes=2**30):
+        self.directory = directory
+        self.version = version
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+    @staticmethod
+    def from_environment(version=''):
+        # the cache is only used if EPISODE_CACHE_DIR is set
+        if 'EPISODE_CACHE_DIR' not in environ:
+            return None
+        max_bytes = int(environ.get('EPISODE_CACHE_MAX_BYTES', 2**30))
+        return DiskEpisodeCache(environ['EPISODE_CACHE_DIR'], version=version, max_bytes=max_bytes)
+    def path(self, key):
+        return join_path(self.directory, sha1((self.version + repr(key)).encode('utf-8')).hexdigest())
+    def get(self, key, build):
+        path = self.path(key)
+        if exists(path):
+            try:
+                store = EpisodeStore.load(path)
+            except (OSError, ValueError):
+                # removed by another process between the check and the load
+                pass
+            else:
+                self.hits += 1
+                utime(path)
+                return store
+        self.misses += 1
+        store = build()
+        self._save_(path, store)
+        return store
+    def _save_(self, path, store):
+        # saved under a temporary name and renamed into place, so that other
+        # processes never see a partial store
+        makedirs(self.directory, exist_ok=True)
+        temp_path = mkdtemp(dir=self.directory, prefix='.')
+        store.save(temp_path)
+        try:
+            rename(temp_path, path)
+        except OSError:
+            # another process saved the same store first
+            rmtree(temp_path, ignore_errors=True)
+        self._evict_()
+    def _evict_(self):
+        entries = []
+        for name in listdir(self.directory):
+            path = join_path(self.directory, name)
+            if name.startswith('.'):
+                continue
+            try:
+                size = sum(getsize(join_path(path, filename)) for filename in listdir(path))
+                entries.append((getmtime(path), size, path))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            rmtree(path, ignore_errors=True)
+            total -= size
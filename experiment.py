@@ -1,15 +1,144 @@
+import csv
+import json
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from getpass import getuser
-from os import getcwd
+from os import fsync, getcwd
+from os.path import exists, getsize
 from socket import gethostname
+from time import monotonic
 
 from permspace import Namespace
+from timing import enable as enable_timing, reset as reset_timing, snapshot as timing_snapshot
+
+class ResultSink(ABC):
+    # keeps one handle on a results file open; rows are flushed (and synced to
+    # disk) every flush_rows rows, every flush_interval seconds, and on close.
+    # Subclasses write the rows and name the extension of results files
+    EXTENSION = None
+    def __init__(self, filename, mode='w', flush_rows=100, flush_interval=60, checkpoint=None):
+        self.filename = filename
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.checkpoint = checkpoint
+        self.fd = open(filename, mode, newline='')
+        self.columns = None
+        self.unflushed_rows = 0
+        self.unflushed_keys = []
+        self.last_flush = monotonic()
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def write_header(self, columns):
+        # appending to a file that already has rows only sets the columns
+        self.columns = list(columns)
+        if self.fd.tell() == 0:
+            self._write_header_()
+    def write_row(self, values, key=None):
+        self._write_row_(values)
+        self.unflushed_rows += 1
+        if key is not None:
+            self.unflushed_keys.append(key)
+        if self.unflushed_rows >= self.flush_rows or monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+    def flush(self):
+        self.fd.flush()
+        fsync(self.fd.fileno())
+        if self.checkpoint is not None:
+            self.checkpoint.record(self.unflushed_keys, self.fd.tell())
+        self.unflushed_rows = 0
+        self.unflushed_keys = []
+        self.last_flush = monotonic()
+    def close(self):
+        if not self.fd.closed:
+            self.flush()
+            self.fd.close()
+    @abstractmethod
+    def _write_header_(self):
+        pass
+    @abstractmethod
+    def _write_row_(self, values):
+        pass
+
+class TSVSink(ResultSink):
+    # tab-separated, but with the .csv extension results have always used
+    EXTENSION = 'csv'
+    def _write_header_(self):
+        self.fd.write('\t'.join(self.columns) + '\n')
+    def _write_row_(self, values):
+        self.fd.write('\t'.join(str(value) for value in values) + '\n')
+
+class CSVSink(ResultSink):
+    # distinguished from tab-separated results by name as well as by delimiter
+    EXTENSION = 'comma.csv'
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writer = csv.writer(self.fd)
+    def _write_header_(self):
+        self.writer.writerow(self.columns)
+    def _write_row_(self, values):
+        self.writer.writerow(values)
+
+class JSONLinesSink(ResultSink):
+    EXTENSION = 'jsonl'
+    def _write_header_(self):
+        pass
+    def _write_row_(self, values):
+        self.fd.write(json.dumps(dict(zip(self.columns, values)), default=str) + '\n')
+
+class Checkpoint:
+    # a manifest of the parameter points whose rows are safely in a results
+    # file; the first line names the results file, the next records its header,
+    # and every flush adds a JSON line with the points it wrote and the file
+    # size after writing them
+    def __init__(self, filename):
+        self.filename = filename
+        self.results_file = None
+        self.header = None
+        self.completed = set()
+        self.size = 0
+        if exists(filename):
+            self._load_()
+    def _load_(self):
+        with open(self.filename) as fd:
+            self.results_file = fd.readline().rstrip('\n')
+            for line in fd:
+                try:
+                    flush = json.loads(line)
+                except ValueError:
+                    # a line cut short by a crash; its rows were never recorded
+                    break
+                if 'header' in flush:
+                    self.header = flush['header']
+                    continue
+                self.completed.update(tuple(key) for key in flush['points'])
+                self.size = flush['size']
+    def start(self, results_file):
+        self.results_file = results_file
+        with open(self.filename, 'w') as fd:
+            fd.write(results_file + '\n')
+    def record_header(self, header):
+        self.header = list(header)
+        self._append_({'header': self.header})
+    def record(self, keys, size):
+        self.completed.update(keys)
+        self.size = size
+        self._append_({'size': size, 'points': keys})
+    def _append_(self, entry):
+        with open(self.filename, 'a') as fd:
+            fd.write(json.dumps(entry) + '\n')
+            fd.flush()
+            fsync(fd.fileno())
 
 class Experiment:
-    def __init__(self, name, parameter_space, function):
+    def __init__(self, name, parameter_space, function, sink=TSVSink):
         self.name = name
         self.parameter_space = parameter_space
         self.function = function
+        self.sink = sink
         self.machine_info = Namespace(
             _username=getuser(),
             _hostname=gethostname(),
@@ -21,37 +150,95 @@ class Experiment:
         self.order.extend(sorted(parameter_space.constants.keys()))
         self.order.extend(sorted(self.machine_info.keys()))
         self.order.extend(['_start_time', '_end_time'])
-    def _run(self, iterator_modifier=None):
-        print_headers = True
-        start_time = datetime.now().isoformat()
-        output_file = '{}-{}-results.csv'.format(self.name, start_time)
-        with open(output_file, 'w') as fd:
-            fd.write('')
+    def _run(self, iterator_modifier=None, num_workers=1, checkpoint=None, timed=False):
+        # with a checkpoint manifest filename, a rerun skips the points the
+        # manifest lists and appends to the results file it names; if timed,
+        # the time spent in each timing phase is added as columns
         iterator = self.parameter_space
         if iterator_modifier is not None:
             iterator = iterator_modifier(iterator)
-        for parameters in iterator:
-            run_info = Namespace(
-                _start_time=datetime.now().isoformat(sep=' '),
-            )
-            results = self.function(parameters)
-            run_info.update(_end_time=datetime.now().isoformat(sep=' '))
-            if print_headers:
-                with open(output_file, 'a') as fd:
-                    fd.write('\t'.join(self.order + sorted(results.keys())) + '\n')
-                print_headers = False
-            csv_row = Namespace()
-            csv_row.update(**parameters)
-            csv_row.update(**results)
-            csv_row.update(**self.machine_info)
-            csv_row.update(**run_info)
-            with open(output_file, 'a') as fd:
-                fd.write(csv_row.to_csv_row(self.order) + '\n')
-    def run(self):
-        self._run()
-    def run_from(self, start=None):
-        self._run((lambda iterator: iterator.iter_from(start)))
-    def run_until(self, end=None):
-        self._run((lambda iterator: iterator.iter_until(end)))
-    def run_between(self, start=None, end=None):
-        self._run((lambda iterator: iterator.iter_between(start, end)))
+        mode = 'w'
+        if checkpoint is not None:
+            checkpoint = Checkpoint(checkpoint)
+        if checkpoint is not None and checkpoint.results_file is not None and exists(checkpoint.results_file):
+            output_file = checkpoint.results_file
+            mode = 'a'
+            # drop rows written after the last recorded flush
+            if getsize(output_file) > checkpoint.size:
+                with open(output_file, 'r+') as fd:
+                    fd.truncate(checkpoint.size)
+            completed = checkpoint.completed
+            iterator = (parameters for parameters in iterator if self._checkpoint_key_(parameters) not in completed)
+        else:
+            start_time = datetime.now().isoformat()
+            output_file = '{}-{}-results.{}'.format(self.name, start_time, self.sink.EXTENSION)
+            if checkpoint is not None:
+                checkpoint.start(output_file)
+        if num_workers > 1:
+            runs = self._execute_parallel_(iterator, num_workers, timed)
+        else:
+            runs = ((parameters, *run_parameters(self.function, parameters, timed)) for parameters in iterator)
+        columns = None
+        with self.sink(output_file, mode=mode, checkpoint=checkpoint) as sink:
+            for parameters, results, run_info in runs:
+                if columns is None:
+                    timing_columns = sorted(set(run_info.keys()) - set(self.order))
+                    columns = self.order + sorted(set(results.keys()) - set(self.order)) + timing_columns
+                    header = self.order + sorted(results.keys()) + timing_columns
+                    if checkpoint is not None:
+                        self._check_header_(checkpoint, header, mode)
+                    sink.write_header(header)
+                row = dict(parameters.items())
+                row.update(results.items())
+                row.update(self.machine_info.items())
+                row.update(run_info.items())
+                sink.write_row(tuple(row[column] for column in columns), key=self._checkpoint_key_(parameters))
+    def _check_header_(self, checkpoint, header, mode):
+        # rows are only appended under the header they were written with;
+        # manifests from before headers were recorded cannot be checked
+        if mode == 'w':
+            checkpoint.record_header(header)
+        elif checkpoint.header is not None and checkpoint.header != header:
+            raise ValueError('cannot resume {}: its columns differ from this run\'s (recorded in {})'.format(checkpoint.results_file, checkpoint.filename))
+    def _checkpoint_key_(self, parameters):
+        return tuple(str(parameters[key]) for key in self.parameter_space.order)
+    def _execute_parallel_(self, iterator, num_workers, timed=False):
+        # runs parameters in worker processes but yields results in iteration
+        # order; only a few parameters per worker are submitted ahead
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            pending = deque()
+            for parameters in iterator:
+                pending.append((parameters, executor.submit(run_parameters, self.function, parameters, timed)))
+                if len(pending) >= 2 * num_workers:
+                    parameters, future = pending.popleft()
+                    yield (parameters, *future.result())
+            while pending:
+                parameters, future = pending.popleft()
+                yield (parameters, *future.result())
+    def run(self, **kwargs):
+        self._run(**kwargs)
+    def run_from(self, start=None, **kwargs):
+        self._run((lambda iterator: iterator.iter_from(start)), **kwargs)
+    def run_until(self, end=None, **kwargs):
+        self._run((lambda iterator: iterator.iter_until(end)), **kwargs)
+    def run_between(self, start=None, end=None, **kwargs):
+        self._run((lambda iterator: iterator.iter_between(start, end)), **kwargs)
+    def run_shard(self, index, num_shards, **kwargs):
+        self._run((lambda iterator: iterator.shard(index, num_shards)), **kwargs)
+
+# module-level so that worker processes can unpickle it
+def run_parameters(function, parameters, timed=False):
+    # timing is only enabled for the run, so later code in the process is not timed
+    was_timed = enable_timing(timed)
+    reset_timing()
+    try:
+        run_info = Namespace(
+            _start_time=datetime.now().isoformat(sep=' '),
+        )
+        results = function(parameters)
+        run_info.update(_end_time=datetime.now().isoformat(sep=' '))
+        if timed:
+            run_info.update(**timing_snapshot())
+    finally:
+        enable_timing(was_timed)
+    return results, run_info
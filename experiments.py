@@ -1,15 +1,24 @@
+from bisect import bisect_left
+from hashlib import sha1
+from itertools import accumulate
 from math import ceil, floor
+from operator import itemgetter
+from os.path import dirname, join as join_path, realpath
 from random import seed as set_seed, randrange, random
 from time import time
 from textwrap import dedent
 
 from rdflib.plugins.sparql import prepareQuery
 
-from chroma_wanderer import random_walk, random_colors, color_episodes, color_episodes_with_changes
-from color import Color, create_knn, closest_color, find_label_index
+from chroma_wanderer import random_walk_array, iter_random_colors, color_episodes, color_episodes_with_changes
+from color import COLOR_CACHE, Color, closest_color, closest_color_indices, colors_to_array, find_label_index, neighbor_labels
+from episodes import DiskEpisodeCache, EpisodeCache, EpisodeStore
 from experiment import Experiment
 from permspace import PermutationSpace, Namespace
 from rdfwrap import NXRDF
+from timing import register as register_timing, timed
+
+register_timing('build', 'search', 'iterate')
 
 EXACT_LABEL_QUERY = prepareQuery(
     dedent('''
@@ -36,15 +45,97 @@ NEIGHBOR_LABELS_QUERY = prepareQuery(
     initNs={'nxrdf':NXRDF.NAMESPACE}
 )
 
+# creates an empty episode graph of the backend named by the episode_backend parameter, if any;
+# the searches only query the graph, so by default NXRDF does not build its networkx side
+def create_episode_graph(parameters):
+    backend = 'rdf'
+    if 'episode_backend' in parameters:
+        backend = parameters.episode_backend
+    if backend == 'columnar':
+        return EpisodeStore()
+    return NXRDF(backend=backend)
+
+# episode graphs are only queried, so points that differ only in the search
+# (algorithm, num_neighbors, target_color, num_trials) share one build
+EPISODE_CACHE = EpisodeCache()
+
+# the files whose contents determine the episodes built from some parameters
+EPISODE_CODE_FILES = ['chroma_wanderer.py', 'color.py', 'episodes.py', 'color-centroids.tsv']
+
+def episode_code_version():
+    digest = sha1()
+    for filename in EPISODE_CODE_FILES:
+        with open(join_path(dirname(realpath(__file__)), filename), 'rb') as fd:
+            digest.update(fd.read())
+    return digest.hexdigest()
+
+# columnar stores can also be saved across processes, if EPISODE_CACHE_DIR is set
+EPISODE_DISK_CACHE = DiskEpisodeCache.from_environment(version=episode_code_version())
+
+def episode_graph_key(parameters):
+    changes = None
+    if 'changes' in parameters:
+        changes = tuple(tuple(change) for change in parameters.changes)
+    backend = None
+    if 'episode_backend' in parameters:
+        backend = parameters.episode_backend
+    return (
+        parameters.random_seed,
+        parameters.num_episodes,
+        parameters.num_labels,
+        parameters.color_sequence_type,
+        episode_walk_mode(parameters),
+        changes,
+        backend,
+    )
+
+# walks are replayed exactly unless the walk_mode parameter asks for the fast, numpy-generated walk
+def episode_walk_mode(parameters):
+    if 'walk_mode' in parameters:
+        return parameters.walk_mode
+    return 'exact'
+
+# builds the episodes of the color sequence the parameters describe, or reuses a cached build
+@timed('build')
+def build_episode_graph(parameters):
+    def build():
+        set_seed(parameters.random_seed)
+        # create episodes of color
+        if parameters.color_sequence_type == 'random':
+            color_list = iter_random_colors(parameters.num_episodes)
+        elif parameters.color_sequence_type == 'walk':
+            color_list = random_walk_array(parameters.num_episodes, mode=episode_walk_mode(parameters))
+        if 'changes' in parameters:
+            return color_episodes_with_changes(color_list, parameters.changes, create_episode_graph(parameters))
+        return color_episodes(color_list, parameters.num_labels, create_episode_graph(parameters))
+    key = episode_graph_key(parameters)
+    if EPISODE_DISK_CACHE is not None and key[-1] == 'columnar':
+        return EPISODE_CACHE.get(key, parameters.num_episodes, (lambda: EPISODE_DISK_CACHE.get(key, build)))
+    return EPISODE_CACHE.get(key, parameters.num_episodes, build)
+
+# finds all episodes in time order, optionally only those with the given label
+def query_episodes(episode_graph, name=None):
+    if isinstance(episode_graph, EpisodeStore):
+        return episode_graph.query_episodes(name)
+    elif name is None:
+        return episode_graph.query(EXACT_LABEL_QUERY)
+    else:
+        return episode_graph.query(EXACT_LABEL_QUERY, initBindings={'name':name})
+
 # finds the color closest to target color and minimum distance
+@timed('iterate')
 def min_color_total_episodes(total_episodes, min_distance, min_color, parameters, results):
     min_time = -1
+    target_color = parameters.target_color
+    target_r, target_g, target_b = target_color.r, target_color.g, target_color.b
     for result in results:
-        episode_color = Color(result[2].value, result[3].value, result[4].value)
-        distance = parameters.target_color - episode_color
+        # int() accepts both rdflib literals and the plain values of an EpisodeStore
+        r, g, b = int(result[2]), int(result[3]), int(result[4])
+        # the distance target_color - Color(r, g, b), without creating the color
+        distance = abs(target_r - r) + abs(target_g - g) + abs(target_b - b)
         if distance < min_distance:
             min_distance = distance # min distance is the RGB distance btwn min_color and target_color
-            min_color = episode_color # min color is the closest color to target color
+            min_color = Color(r, g, b) # min color is the closest color to target color
             min_time = result[0]
         total_episodes += 1
     return min_time, min_color, total_episodes
@@ -58,7 +149,7 @@ def run_brute_force(parameters, episode_graph):
     min_color = None
 
     # for every color in graph, find closest color to target color, distance btwn two colors, and # episodes
-    results = episode_graph.query(EXACT_LABEL_QUERY)
+    results = query_episodes(episode_graph)
     min_time, min_color, total_episodes = min_color_total_episodes(total_episodes, min_distance, min_color, parameters, results)
 
     # return min color and total episodes
@@ -75,7 +166,7 @@ def run_exact_heuristic(parameters, episode_graph):
     min_color = None
 
     # loop through all colors with same label as target, find closest to target color, distance btwn them, and # episodes
-    results = episode_graph.query(EXACT_LABEL_QUERY, initBindings={'name':label_color.name})
+    results = query_episodes(episode_graph, label_color.name)
     min_time, min_color, total_episodes = min_color_total_episodes(total_episodes, min_distance, min_color, parameters, results)
 
     return min_time, min_color, total_episodes
@@ -85,8 +176,7 @@ def run_neighbor_heuristic(parameters, episode_graph):
     label_color = closest_color(parameters.target_color, num_colors=parameters.num_labels)
 
     # isolate all neighbor labels of target semantic label
-    knn = create_knn(parameters.num_labels, parameters.num_neighbors)
-    neighbors = knn.query(NEIGHBOR_LABELS_QUERY, initBindings={'name':label_color.name})
+    neighbors = neighbor_labels(label_color.name, parameters.num_labels, parameters.num_neighbors)
 
     # metrics
     total_episodes = 0
@@ -95,50 +185,167 @@ def run_neighbor_heuristic(parameters, episode_graph):
     min_color = None
 
     # loop through each neighbor label
-    for row in neighbors:
-        neighbor_name = row[0].value
+    for neighbor_name in neighbors:
 
         # loop through each color within neighbor label and find min color and total episodes
-        results = episode_graph.query(EXACT_LABEL_QUERY, initBindings={'name':neighbor_name})
+        results = query_episodes(episode_graph, neighbor_name)
         min_time, min_color, total_episodes = min_color_total_episodes(total_episodes, min_distance, min_color, parameters, results)
 
     # return min color and total episodes
     return min_time, min_color, total_episodes
 
+# the color each label names; the first color wins if names repeat, as in find_label_index
+LABEL_CENTROIDS = {}
+for color in COLOR_CACHE:
+    LABEL_CENTROIDS.setdefault(color.name, color)
+
+def run_bounded_search(parameters, episode_graph, names):
+    # finds the episode closest to target color among the labels, skipping
+    # episodes that cannot beat the best so far: by the triangle inequality, an
+    # episode at distance d from its label's centroid is at least
+    # |distance(target, centroid) - d| from the target. Labels are searched
+    # nearest centroid first, and the search stops once no remaining label can
+    # hold a closer episode. Ties go to the earliest episode
+    assert isinstance(episode_graph, EpisodeStore), 'bounded search needs the columnar episode backend'
+    target_color = parameters.target_color
+    target_r, target_g, target_b = target_color.r, target_color.g, target_color.b
+    rings = []
+    for name in names:
+        centroid = LABEL_CENTROIDS[name]
+        distances, nodes = episode_graph.ring(name, centroid)
+        if nodes:
+            rings.append((target_color - centroid, distances, nodes))
+    rings.sort(key=itemgetter(0))
+    total_episodes = sum(len(nodes) for _, _, nodes in rings)
+    # the largest radius of this and every later label, to stop once none can hold a closer episode
+    radii = [distances[-1] for _, distances, _ in rings]
+    max_radii = list(accumulate(reversed(radii), max))[::-1]
+    inspected_episodes = 0
+    min_time = -1
+    min_distance = 3 * 255
+    min_color = None
+    # as in the scan, only episodes strictly closer than min_distance count
+    min_key = (min_distance, -1)
+    for (center, distances, nodes), max_radius in zip(rings, max_radii):
+        if center - max_radius > min_key[0]:
+            break
+        # inspect the episodes outward from the ones as far from the centroid as the target is
+        high = bisect_left(distances, center)
+        low = high - 1
+        while low >= 0 or high < len(nodes):
+            # take the side whose next episode has the smaller bound
+            if high >= len(nodes) or (low >= 0 and center - distances[low] <= distances[high] - center):
+                bound = center - distances[low]
+                position = low
+                low -= 1
+            else:
+                bound = distances[high] - center
+                position = high
+                high += 1
+            if bound > min_key[0]:
+                break
+            node = nodes[position]
+            r, g, b = episode_graph.reds[node], episode_graph.greens[node], episode_graph.blues[node]
+            distance = abs(target_r - r) + abs(target_g - g) + abs(target_b - b)
+            inspected_episodes += 1
+            key = (distance, episode_graph.times[node])
+            if key < min_key:
+                min_key = key
+                min_time = episode_graph.times[node]
+                min_color = Color(r, g, b)
+    return min_time, min_color, total_episodes, inspected_episodes
+
+# runs the named search, returning (time, color, total_episodes, inspected_episodes); with the
+# search_mode parameter set to 'bounded', the heuristics skip episodes that cannot be closest
+@timed('search')
+def run_search(algorithm, parameters, episode_graph):
+    bounded = 'search_mode' in parameters and parameters.search_mode == 'bounded'
+    if bounded and algorithm == 'exact-heuristic':
+        label_color = closest_color(parameters.target_color, num_colors=parameters.num_labels)
+        return run_bounded_search(parameters, episode_graph, [label_color.name])
+    elif bounded and algorithm == 'neighbor-heuristic':
+        # unlike run_neighbor_heuristic, this finds the closest episode over all the neighbor labels
+        label_color = closest_color(parameters.target_color, num_colors=parameters.num_labels)
+        neighbors = neighbor_labels(label_color.name, parameters.num_labels, parameters.num_neighbors)
+        return run_bounded_search(parameters, episode_graph, neighbors)
+    elif algorithm == 'exact-heuristic':
+        min_time, min_color, total_episodes = run_exact_heuristic(parameters, episode_graph)
+    elif algorithm == 'neighbor-heuristic':
+        min_time, min_color, total_episodes = run_neighbor_heuristic(parameters, episode_graph)
+    else:
+        min_time, min_color, total_episodes = run_brute_force(parameters, episode_graph)
+    return min_time, min_color, total_episodes, total_episodes
+
+# runs the named search for many target colors at once over a columnar episode
+# store; returns a (time, color, total_episodes) tuple for each target color, as
+# run_brute_force, run_exact_heuristic and run_neighbor_heuristic would
+def batch_search(episode_graph, target_colors, algorithm, num_labels, num_neighbors=0):
+    assert isinstance(episode_graph, EpisodeStore), 'batch search needs the columnar episode backend'
+    targets = colors_to_array(target_colors)
+    if algorithm == 'brute-force':
+        best_nodes = episode_graph.nearest(targets)
+        return [
+            (*batch_answer(episode_graph, node, None), len(episode_graph))
+            for node in best_nodes.tolist()
+        ]
+    label_names = [COLOR_CACHE[index].name for index in closest_color_indices(targets, num_labels)]
+    results = len(targets) * [None]
+    # targets with the same label search the same labels, so each label is searched once per group
+    groups = {}
+    for position, name in enumerate(label_names):
+        groups.setdefault(name, []).append(position)
+    for name, positions in groups.items():
+        if algorithm == 'exact-heuristic':
+            names = [name]
+        else:
+            names = neighbor_labels(name, num_labels, num_neighbors)
+        total_episodes = sum(len(episode_graph.partition(neighbor_name)) for neighbor_name in names)
+        # like run_neighbor_heuristic, the time is from the last label, and the
+        # color from the last label with an episode
+        answers = len(positions) * [(-1, None)]
+        for neighbor_name in names:
+            best_nodes = episode_graph.nearest(targets[positions], name=neighbor_name)
+            answers = [batch_answer(episode_graph, node, color) for node, (_, color) in zip(best_nodes.tolist(), answers)]
+        for position, answer in zip(positions, answers):
+            results[position] = (*answer, total_episodes)
+    return results
+
+def batch_answer(episode_graph, node, default_color):
+    if node < 0:
+        return -1, default_color
+    return episode_graph.times[node], Color(episode_graph.reds[node], episode_graph.greens[node], episode_graph.blues[node])
+
 # making the graph is now different
 # function runs experiment according to parameters set within parameter space
 def run_static_experiment(parameters):
-    set_seed(parameters.random_seed)
-
-    # create episodes of color
-    if parameters.color_sequence_type == 'random':
-        color_list = random_colors(parameters.num_episodes)
-    elif parameters.color_sequence_type == 'walk':
-        color_list = random_walk(parameters.num_episodes)
-    episode_graph = color_episodes(color_list, parameters.num_labels)
+    episode_graph = build_episode_graph(parameters)
 
     # initializations
     answer = None
     total_episodes = 0
+    inspected_episodes = 0
     num_fallbacks = 0
 
     start_time = time() # start clock
 
     # if current algorithm is exact or neighbor heuristic, run exact label algorithm first and add an episode to total
     if parameters.algorithm in ['exact-heuristic', 'neighbor-heuristic']:
-        answer_episode, answer, section_episodes = run_exact_heuristic(parameters, episode_graph)
+        answer_episode, answer, section_episodes, section_inspected = run_search('exact-heuristic', parameters, episode_graph)
         total_episodes += section_episodes
+        inspected_episodes += section_inspected
 
     # if exact heuristic yields no result and algorithm is neighbor heuristic, add one to episodes and fallbacks
     if answer is None and parameters.algorithm == 'neighbor-heuristic':
-        answer_episode, answer, section_episodes = run_neighbor_heuristic(parameters, episode_graph)
+        answer_episode, answer, section_episodes, section_inspected = run_search('neighbor-heuristic', parameters, episode_graph)
         total_episodes += section_episodes
+        inspected_episodes += section_inspected
         num_fallbacks += 1
 
     # if no answer, run brute force algorithm
     if answer is None:
-        answer_episode, answer, section_episodes = run_brute_force(parameters, episode_graph)
+        answer_episode, answer, section_episodes, section_inspected = run_search('brute-force', parameters, episode_graph)
         total_episodes += section_episodes
+        inspected_episodes += section_inspected
         if parameters.algorithm != 'brute-force':
             num_fallbacks += 1
 
@@ -150,6 +357,7 @@ def run_static_experiment(parameters):
         answer=answer,
         answer_episode=answer_episode,
         total_episodes=total_episodes,
+        inspected_episodes=inspected_episodes,
         num_fallbacks=num_fallbacks,
         runtime=runtime,
     )
@@ -205,38 +413,34 @@ def generate_changes(num_episodes, num_labels): # add number of changes?
 
 # making the graph is now different
 def run_dynamic_experiment(parameters):
-    set_seed(parameters.random_seed)
-
-    # create episodes of color
-    if parameters.color_sequence_type == 'random':
-        color_list = random_colors(parameters.num_episodes)
-    elif parameters.color_sequence_type == 'walk':
-        color_list = random_walk(parameters.num_episodes)
-
-    episode_graph = color_episodes_with_changes(color_list, parameters.changes)
+    episode_graph = build_episode_graph(parameters)
 
     # initializations
     answer = None
     total_episodes = 0
+    inspected_episodes = 0
     num_fallbacks = 0
 
     start_time = time() # start clock
 
     # if current algorithm is exact or neighbor heuristic, run exact label algorithm first and add an episode to total
     if parameters.algorithm in ['exact-heuristic', 'neighbor-heuristic']:
-        answer_episode, answer, section_episodes = run_exact_heuristic(parameters, episode_graph)
+        answer_episode, answer, section_episodes, section_inspected = run_search('exact-heuristic', parameters, episode_graph)
         total_episodes += section_episodes
+        inspected_episodes += section_inspected
 
     # if exact heuristic yields no result and algorithm is neighbor heuristic, add one to episodes and fallbacks
     if answer is None and parameters.algorithm == 'neighbor-heuristic':
-        answer_episode, answer, section_episodes = run_neighbor_heuristic(parameters, episode_graph)
+        answer_episode, answer, section_episodes, section_inspected = run_search('neighbor-heuristic', parameters, episode_graph)
         total_episodes += section_episodes
+        inspected_episodes += section_inspected
         num_fallbacks += 1
 
     # if no answer, run brute force algorithm
     if answer is None:
-        answer_episode, answer, section_episodes = run_brute_force(parameters, episode_graph)
+        answer_episode, answer, section_episodes, section_inspected = run_search('brute-force', parameters, episode_graph)
         total_episodes += section_episodes
+        inspected_episodes += section_inspected
         if parameters.algorithm != 'brute-force':
             num_fallbacks += 1
 
@@ -248,6 +452,7 @@ def run_dynamic_experiment(parameters):
         answer=answer,
         answer_episode=answer_episode,
         total_episodes=total_episodes,
+        inspected_episodes=inspected_episodes,
         num_fallbacks=num_fallbacks,
         runtime=runtime,
     )
@@ -258,11 +463,17 @@ def create_dynamic_experiment_pilot():
     target_colors = [Color(randrange(256), randrange(256), randrange(256)) for i in range(num_target_colors)]
     num_random_seeds = 10
     random_seeds = [random() for i in range(num_random_seeds)]
+    num_labels_values = [20, 50, 100]
+    # label every target color for every label count up front
+    target_labels = {}
+    for num_labels in num_labels_values:
+        for target_color, label_index in zip(target_colors, closest_color_indices(target_colors, num_labels)):
+            target_labels[(num_labels, target_color)] = COLOR_CACHE[label_index].name
     # parameter space is an instance of Permutation space. Allows us to manipulate many variables in experiment.
     parameter_space = PermutationSpace(['num_episodes', 'num_labels', 'target_color', 'random_seed', 'num_trials', 'algorithm', 'num_neighbors'],
             num_episodes=[1000, 10000],
 
-            num_labels=[20, 50, 100],
+            num_labels=num_labels_values,
 
             # will work across a variability of different types of colors
             random_seed=random_seeds,
@@ -283,7 +494,7 @@ def create_dynamic_experiment_pilot():
             #    [Color(randrange(256), randrange(256), randrange(256)) for i in range(num_target_colors)]))
 
             target_color_hex=(lambda target_color: str(target_color)),
-            target_label=(lambda num_labels, target_color: closest_color(target_color, num_colors=num_labels).name),
+            target_label=(lambda num_labels, target_color: target_labels[(num_labels, target_color)]),
             target_label_index=(lambda target_label: find_label_index(target_label)),
             target_label_episode=(lambda changes, target_label_index: [episode for episode, label in changes if label >= target_label_index][0]),
     )
@@ -1,4 +1,6 @@
+from collections import OrderedDict
 from inspect import signature
+from itertools import product
 
 class Namespace:
     def __init__(self, **kwargs):
@@ -40,6 +42,11 @@ class Namespace:
         if key in self._internal_:
             del self._internal_[key]
             del self.__dict__[key]
+    def __getstate__(self):
+        return self._internal_
+    def __setstate__(self, state):
+        self.__dict__['_internal_'] = {}
+        self.update(**state)
     def __str__(self):
         return 'Namespace(' + ', '.join('{}={}'.format(k, repr(v)) for k, v in sorted(self._internal_.items())) + ')'
     def update(self, **kwargs):
@@ -66,6 +73,84 @@ class Namespace:
         order = self._expand_order_(order)
         return '\t'.join(str(self[k]) for k in order)
 
+class RecordSchema:
+    # the field order shared by every record a parameter space produces
+    RESERVED = set(['keys', 'values', 'items', 'to_tuple', 'to_csv_row'])
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        reserved = RecordSchema.RESERVED & set(self.fields)
+        if reserved:
+            raise KeyError('{} is reserved and is not allowed as a key'.format(repr(sorted(reserved)[0])))
+        self.index = dict((field, position) for position, field in enumerate(self.fields))
+        self._orders_ = {}
+    def positions(self, order):
+        # the positions of the fields in order, followed by the remaining fields
+        # sorted, like Namespace._expand_order_
+        order = tuple(order)
+        if order not in self._orders_:
+            expanded = list(order) + sorted(set(self.fields) - set(order))
+            self._orders_[order] = tuple(self.index[field] for field in expanded)
+        return self._orders_[order]
+
+class Record:
+    # a frozen Namespace: the same read API, with values stored in a tuple
+    # whose field order is shared through a RecordSchema
+    __slots__ = ('_schema_', '_values_', '_csv_rows_')
+    def __init__(self, schema, values):
+        object.__setattr__(self, '_schema_', schema)
+        object.__setattr__(self, '_values_', tuple(values))
+        object.__setattr__(self, '_csv_rows_', None)
+    def __reduce__(self):
+        return (_make_record_, (self._schema_.fields, self._values_))
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return dict(self.items()) == dict(other.items())
+        if isinstance(other, Namespace):
+            return dict(self.items()) == other._internal_
+        return False
+    def __len__(self):
+        return len(self._values_)
+    def __contains__(self, key):
+        return key in self._schema_.index
+    def __getitem__(self, key):
+        try:
+            return self._values_[self._schema_.index[key]]
+        except KeyError:
+            raise KeyError('{} object has no attribute {}'.format(repr(self.__class__.__name__), repr(key)))
+    def __getattr__(self, key):
+        # only called for names that are not slots or methods
+        try:
+            return self._values_[self._schema_.index[key]]
+        except KeyError:
+            raise AttributeError('{} object has no attribute {}'.format(repr(self.__class__.__name__), repr(key)))
+    def __setattr__(self, key, value):
+        raise AttributeError('{} object is frozen'.format(repr(self.__class__.__name__)))
+    def __delattr__(self, key):
+        raise AttributeError('{} object is frozen'.format(repr(self.__class__.__name__)))
+    def __str__(self):
+        return 'Record(' + ', '.join('{}={}'.format(k, repr(v)) for k, v in sorted(self.items())) + ')'
+    def keys(self):
+        return self._schema_.fields
+    def values(self):
+        return self._values_
+    def items(self):
+        return zip(self._schema_.fields, self._values_)
+    def to_namespace(self):
+        return Namespace(**dict(self.items()))
+    def to_tuple(self, order):
+        values = self._values_
+        return tuple(values[position] for position in self._schema_.positions(order))
+    def to_csv_row(self, order):
+        order = tuple(order)
+        if self._csv_rows_ is None:
+            object.__setattr__(self, '_csv_rows_', {})
+        if order not in self._csv_rows_:
+            self._csv_rows_[order] = '\t'.join(str(value) for value in self.to_tuple(order))
+        return self._csv_rows_[order]
+
+def _make_record_(fields, values):
+    return Record(RecordSchema(fields), values)
+
 class MixedRadix:
     def __init__(self, radixes, init_values=None):
         self.radixes = radixes
@@ -117,33 +202,108 @@ class ParameterSpaceIterator:
                 assert value in self.pspace.independents[key], 'unknown value for end parameter {}: {}'.format(key, repr(value))
                 index = self.pspace.order.index(key)
                 self._end_indices_[index] = self.pspace.independents[key].index(value)
+        self._level_dependents_, self._level_filters_ = self.pspace._compile_levels_()
+        self._subtree_sizes_ = []
+        size = 1
+        for radix in reversed(self.pspace.ordered_sizes):
+            self._subtree_sizes_.append(size)
+            size *= radix
+        self._subtree_sizes_.reverse()
+        # the linear index iteration stops at, so that skipped subtrees are only
+        # counted up to it
+        self._end_position_ = size
+        if self._end_indices_:
+            self._end_position_ = self._position_(self._end_indices_)
+        # values of the parameters bound so far; places after the first one that
+        # changes are rebound, so values from skipped subtrees are overwritten
+        self._values_ = dict(self.pspace.constants)
+        self._schema_ = self.pspace.schema
+        self._bound_indices_ = None
+        self.num_generated = 0
+        self.num_rejected = 0
     def __iter__(self):
         return self
     def __next__(self):
-        conflicts = True
         min_place = len(self.pspace.order) - 1
-        while conflicts:
+        while True:
             next_index = self._state_.next(min_place)
             if self._end_indices_ and next_index >= self._end_indices_:
                 raise StopIteration
-            next_state = self.pspace._get_namespace_from_indices_(next_index)
-            conflicts = self._check_filters_(next_state)
-            if conflicts:
-                min_place = min(max(self.pspace.order.index(parameter) for parameter in parameters) for parameters in conflicts)
-        return next_state
-    def _check_filters_(self, result):
-        conflicts = []
-        for fn in self.pspace.filters:
-            if not fn(**result):
-                conflicts.append(set.union(*(self.pspace.dependency_closure[argument] for argument in fn.arguments)))
-        return conflicts
+            rejected_place = self._bind_(next_index)
+            if rejected_place is None:
+                self.num_generated += 1
+                return self._namespace_()
+            # skip every point that shares the rejected prefix, from this one to
+            # the end of the subtree or of the iteration
+            position = self._position_(next_index)
+            subtree_size = self._subtree_sizes_[rejected_place]
+            subtree_end = position - position % subtree_size + subtree_size
+            self.num_rejected += min(subtree_end, self._end_position_) - position
+            min_place = rejected_place
+    def _position_(self, indices):
+        return sum(index * size for index, size in zip(indices, self._subtree_sizes_))
+    def _bind_(self, indices):
+        # binds places in order, evaluating dependents and filters as soon as
+        # the independents they depend on are bound; returns the place at which
+        # a filter failed, or None if the point passes
+        first_place = 0
+        if self._bound_indices_ is not None:
+            while first_place < len(indices) - 1 and indices[first_place] == self._bound_indices_[first_place]:
+                first_place += 1
+        self._bound_indices_ = list(indices)
+        values = self._values_
+        for place in range(first_place, len(indices)):
+            parameter = self.pspace.order[place]
+            values[parameter] = self.pspace.independents[parameter][indices[place]]
+            for dependent in self._level_dependents_[place]:
+                values[dependent] = self.pspace.dependents[dependent](**values)
+            for fn in self._level_filters_[place]:
+                if not fn(**values):
+                    return place
+        return None
+    def _namespace_(self):
+        values = self._values_
+        return Record(self._schema_, [values[field] for field in self._schema_.fields])
+
+def impure(fn):
+    # marks a dependent or filter as impure, so it is called at every point
+    # instead of being memoized on its argument values
+    fn.impure = True
+    return fn
 
 class FunctionWrapper:
-    def __init__(self, fn):
+    CACHE_SIZE = 4096
+    def __init__(self, fn, cache_size=None):
         self.fn = fn
         self.arguments = tuple(signature(self.fn).parameters.keys())
+        self.pure = not getattr(fn, 'impure', False)
+        if cache_size is None:
+            cache_size = FunctionWrapper.CACHE_SIZE
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
     def __call__(self, **kwargs):
-        return self.fn(**dict((k, v) for k, v in kwargs.items() if k in self.arguments))
+        kwargs = dict((k, v) for k, v in kwargs.items() if k in self.arguments)
+        if not self.pure or self.cache_size <= 0:
+            return self.fn(**kwargs)
+        # types are part of the key so that, eg, 1 and 1.0 are not conflated
+        key = tuple((type(kwargs.get(argument)), kwargs.get(argument)) for argument in self.arguments)
+        try:
+            result = self.cache[key]
+        except TypeError:
+            # unhashable arguments are never memoized
+            return self.fn(**kwargs)
+        except KeyError:
+            self.misses += 1
+            result = self.fn(**kwargs)
+            self.cache[key] = result
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return result
+        self.hits += 1
+        self.cache.move_to_end(key)
+        return result
 
 class PermutationSpace:
     def __init__(self, order, **kwargs):
@@ -154,6 +314,7 @@ class PermutationSpace:
         self.constants = {}
         self.filters = []
         self.order = list(order)
+        self._schema_ = None
         for key, value in kwargs.items():
             if hasattr(value, '__iter__') and not isinstance(value, str):
                 self.independents[key] = list(value)
@@ -208,6 +369,13 @@ class PermutationSpace:
     def _simplify_order_(self):
         self.order = [parameter for parameter in self.order if parameter in self.independents]
     @property
+    def schema(self):
+        # the field order of the records this space produces
+        fields = self.order + list(self.constants.keys()) + self.dependents_topo
+        if self._schema_ is None or self._schema_.fields != tuple(fields):
+            self._schema_ = RecordSchema(fields)
+        return self._schema_
+    @property
     def parameters(self):
         return set.union(
             set(self.independents.keys()),
@@ -224,7 +392,109 @@ class PermutationSpace:
     def ordered_sizes(self):
         return [len(self.independents[parameter]) for parameter in self.order]
     def __len__(self):
-        return len(list(self.__iter__()))
+        return self.count()
+    def __getitem__(self, index):
+        # the index-th point that passes the filters, in iteration order, as
+        # counted by len; each place is chosen by counting the passing points
+        # under each of its values
+        total = len(self)
+        if index < 0:
+            index += total
+        if not 0 <= index < total:
+            raise IndexError('parameter space index out of range: {}'.format(index))
+        filter_places = self._filter_places_
+        sizes = self.ordered_sizes
+        passing = self._passing_filter_indices_()
+        indices = []
+        for place, size in enumerate(sizes):
+            others = 1
+            for later_place in range(place + 1, len(sizes)):
+                if later_place not in filter_places:
+                    others *= sizes[later_place]
+            for value in range(size):
+                if place in filter_places:
+                    position = filter_places.index(place)
+                    matching = [key for key in passing if key[position] == value]
+                else:
+                    matching = passing
+                block = len(matching) * others
+                if index < block:
+                    indices.append(value)
+                    passing = matching
+                    break
+                index -= block
+        return self._get_namespace_from_indices_(indices)
+    @property
+    def _filter_places_(self):
+        # the positions in order of the independents that some filter depends on
+        relevant = set()
+        for fn in self.filters:
+            for argument in fn.arguments:
+                relevant.update(self.dependency_closure[argument])
+        return [place for place, parameter in enumerate(self.order) if parameter in relevant]
+    @property
+    def _filter_dependents_(self):
+        # the dependents that filters need, in topological order
+        needed = set()
+        pending = [argument for fn in self.filters for argument in fn.arguments]
+        while pending:
+            parameter = pending.pop()
+            if parameter in self.dependents and parameter not in needed:
+                needed.add(parameter)
+                pending.extend(self.dependents[parameter].arguments)
+        return [parameter for parameter in self.dependents_topo if parameter in needed]
+    def _passes_filters_(self, indices, filter_dependents):
+        # checks the filters without evaluating dependents they do not need
+        values = dict(self.constants)
+        for parameter, index in zip(self.order, indices):
+            values[parameter] = self.independents[parameter][index]
+        for parameter in filter_dependents:
+            values[parameter] = self.dependents[parameter](**values)
+        return all(fn(**values) for fn in self.filters)
+    def _passing_filter_indices_(self):
+        # the indices of the independents that filters depend on (at the places
+        # of _filter_places_) for which the filters pass, in iteration order
+        filter_places = self._filter_places_
+        filter_dependents = self._filter_dependents_
+        sizes = self.ordered_sizes
+        passing = []
+        indices = len(sizes) * [0]
+        for filter_indices in product(*(range(sizes[place]) for place in filter_places)):
+            for place, index in zip(filter_places, filter_indices):
+                indices[place] = index
+            if self._passes_filters_(indices, filter_dependents):
+                passing.append(filter_indices)
+        return passing
+    def count(self):
+        # counts the points that pass the filters without building them; only
+        # the independents that filters depend on are enumerated
+        filter_places = self._filter_places_
+        others = 1
+        for place, size in enumerate(self.ordered_sizes):
+            if place not in filter_places:
+                others *= size
+        return len(self._passing_filter_indices_()) * others
+    def shard(self, index, num_shards):
+        # iterates over the index-th of num_shards contiguous runs of the points
+        # that pass the filters; runs differ in length by at most one point
+        assert 0 <= index < num_shards, 'shard index must be in [0, {})'.format(num_shards)
+        total = self.count()
+        start = index * total // num_shards
+        end = (index + 1) * total // num_shards
+        filter_places = self._filter_places_
+        filter_dependents = self._filter_dependents_
+        passes = {}
+        position = 0
+        for indices in product(*(range(size) for size in self.ordered_sizes)):
+            if position >= end:
+                return
+            key = tuple(indices[place] for place in filter_places)
+            if key not in passes:
+                passes[key] = self._passes_filters_(indices, filter_dependents)
+            if passes[key]:
+                if position >= start:
+                    yield self._get_namespace_from_indices_(list(indices))
+                position += 1
     def __iter__(self):
         return ParameterSpaceIterator(self)
     def iter_from(self, start=None):
@@ -247,6 +517,27 @@ class PermutationSpace:
         if not set(wrapped_function.arguments) <= self.parameters:
             raise ValueError('filter contains undefined/unreachable arguments')
         self.filters.append(wrapped_function)
+    def _compile_levels_(self):
+        # assigns each dependent and filter to the first place in order at which
+        # every independent it depends on is bound; impure functions, and
+        # anything that uses their values, are deferred to the last place
+        places = dict((parameter, place) for place, parameter in enumerate(self.order))
+        impures = set()
+        def level(fn):
+            if not fn.pure or impures & set(fn.arguments):
+                return len(self.order) - 1
+            closure = set.union(set(), *(self.dependency_closure[argument] for argument in fn.arguments))
+            return max((places[parameter] for parameter in closure if parameter in places), default=0)
+        level_dependents = [[] for _ in self.order]
+        for parameter in self.dependents_topo:
+            fn = self.dependents[parameter]
+            if not fn.pure or impures & set(fn.arguments):
+                impures.add(parameter)
+            level_dependents[level(fn)].append(parameter)
+        level_filters = [[] for _ in self.order]
+        for fn in self.filters:
+            level_filters[level(fn)].append(fn)
+        return level_dependents, level_filters
     def _get_independents_from_indices_(self, indices):
         assert len(indices) == len(self.order)
         assert all(index < len(self.independents[key]) for index, key in zip(indices, self.order))
@@ -255,9 +546,11 @@ class PermutationSpace:
             result[parameter] = self.independents[parameter][index]
         return result
     def _get_namespace_from_indices_(self, indices):
-        result = self._get_independents_from_indices_(indices)
-        for parameter, value in self.constants.items():
-            result[parameter] = value
+        assert len(indices) == len(self.order)
+        values = dict(self.constants)
+        for parameter, index in zip(self.order, indices):
+            values[parameter] = self.independents[parameter][index]
         for parameter in self.dependents_topo:
-            result[parameter] = self.dependents[parameter](**result)
-        return result
+            values[parameter] = self.dependents[parameter](**values)
+        schema = self.schema
+        return Record(schema, [values[field] for field in schema.fields])
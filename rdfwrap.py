@@ -1,39 +1,311 @@
+import gc
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+
 from networkx import DiGraph
 from networkx.drawing.nx_agraph import to_agraph
-from rdflib import Graph as RDFGraph, BNode, Literal, Namespace
+from rdflib import Graph as RDFGraph, BNode, Literal, Namespace, URIRef, Variable
+from rdflib.plugins.sparql.parserutils import CompValue
+from rdflib.query import Result
+
+from timing import register as register_timing, span
+
+register_timing('insert', 'query_prepare', 'query_execute')
+
+@contextmanager
+def gc_paused():
+    # bulk loads only create long-lived objects, so collection cycles during
+    # them are wasted work
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+class StarQueryPlan:
+    # a native plan for prepared SELECT queries whose body is a single basic
+    # graph pattern with fixed predicates, optionally with DISTINCT and ORDER BY
+    # over variables; for_query returns None for any other query
+    def __init__(self, triples, variables, distinct, order):
+        self.triples = triples
+        self.variables = variables
+        self.distinct = distinct
+        self.order = order
+    @staticmethod
+    def for_query(query):
+        node = getattr(query, 'algebra', None)
+        if not isinstance(node, CompValue) or node.name != 'SelectQuery' or node.datasetClause:
+            return None
+        node = node.p
+        distinct = (node.name == 'Distinct')
+        if distinct:
+            node = node.p
+        if node.name != 'Project':
+            return None
+        variables = list(node.PV)
+        node = node.p
+        order = []
+        if node.name == 'OrderBy':
+            for condition in node.expr:
+                if isinstance(condition, Variable):
+                    order.append((condition, False))
+                elif isinstance(condition, CompValue) and isinstance(condition.expr, Variable):
+                    order.append((condition.expr, condition.order == 'DESC'))
+                else:
+                    return None
+            node = node.p
+        if node.name != 'BGP':
+            return None
+        triples = list(node.triples)
+        if not all(isinstance(predicate, URIRef) for _, predicate, _ in triples):
+            return None
+        return StarQueryPlan(triples, variables, distinct, order)
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def for_prepared_query(query):
+        # plans of the most recently used prepared queries, by query object;
+        # None marks prepared queries that rdflib evaluates. Query strings are
+        # never passed here, so ad-hoc queries are not cached
+        return StarQueryPlan.for_query(query)
+    def _join_order_(self, bound):
+        # greedily evaluate triples whose subject or object is already bound first
+        bound = set(bound)
+        remaining = list(self.triples)
+        ordered = []
+        while remaining:
+            triple = max(remaining, key=(lambda triple: sum(
+                (not isinstance(term, Variable) or term in bound) for term in (triple[0], triple[2])
+            )))
+            remaining.remove(triple)
+            ordered.append(triple)
+            bound.update(term for term in (triple[0], triple[2]) if isinstance(term, Variable))
+        return ordered
+    def execute(self, graph, bindings):
+        bindings = dict((Variable(key), value) for key, value in bindings.items())
+        solutions = list(self._match_(graph, self._join_order_(bindings.keys()), bindings))
+        for variable, descending in reversed(self.order):
+            solutions.sort(key=(lambda solution: solution[variable].toPython()), reverse=descending)
+        rows = ([(variable, solution[variable]) for variable in self.variables] for solution in solutions)
+        if self.distinct:
+            seen = set()
+            distinct_rows = []
+            for row in rows:
+                key = tuple(value for _, value in row)
+                if key not in seen:
+                    seen.add(key)
+                    distinct_rows.append(row)
+            rows = distinct_rows
+        result = Result('SELECT')
+        result.vars = self.variables
+        result.bindings = [dict(row) for row in rows]
+        return result
+    def _match_(self, graph, triples, bindings):
+        if not triples:
+            yield bindings
+            return
+        (subject, predicate, obj), rest = triples[0], triples[1:]
+        subject = bindings.get(subject, subject)
+        obj = bindings.get(obj, obj)
+        subject_bound = not isinstance(subject, Variable)
+        object_bound = not isinstance(obj, Variable)
+        if subject_bound and object_bound:
+            if obj in graph.subject_index[predicate].get(subject, ()):
+                yield from self._match_(graph, rest, bindings)
+        elif subject_bound:
+            for value in graph.subject_index[predicate].get(subject, ()):
+                yield from self._match_(graph, rest, {**bindings, obj: value})
+        elif object_bound:
+            for value in graph.object_index[predicate].get(obj, ()):
+                yield from self._match_(graph, rest, {**bindings, subject: value})
+        else:
+            for subject_value, values in graph.subject_index[predicate].items():
+                for value in values:
+                    if subject == obj and subject_value != value:
+                        continue
+                    yield from self._match_(graph, rest, {**bindings, subject: subject_value, obj: value})
 
 class NXRDF:
     NAMESPACE = Namespace('http://justinnhli.com/attr#')
-    def __init__(self):
-        self.nx = DiGraph()
-        self.rdf = RDFGraph()
-        self.rdf.bind('nxrdf', NXRDF.NAMESPACE)
+    BACKENDS = ('rdf', 'nx', 'both')
+    def __init__(self, backend='both'):
+        # backend chooses which representations are built as edges are added;
+        # a missing one is materialized from the other when first needed
+        assert backend in NXRDF.BACKENDS, 'unknown backend: {}'.format(repr(backend))
+        self.backend = backend
+        self._nx_ = None
+        self._rdf_ = None
         self.node_id = 0
+        # edges networkx overwrote (same endpoints, new label) while it was the
+        # only representation, so that the rdf side can still be rebuilt
+        self._overwritten_edges_ = []
+        if backend in ('rdf', 'both'):
+            self._init_rdf_()
+        if backend in ('nx', 'both'):
+            self._nx_ = DiGraph()
+    def _init_rdf_(self):
+        self._rdf_ = RDFGraph()
+        self._rdf_.bind('nxrdf', NXRDF.NAMESPACE)
+        # (predicate, [(parent, child), ...]) groups from add_edges that have
+        # not been loaded into rdflib yet
+        self._pending_triples_ = []
+        # predicate -> subject -> objects, and predicate -> object -> subjects
+        self.subject_index = defaultdict(dict)
+        self.object_index = defaultdict(dict)
+    @property
+    def has_rdf(self):
+        return self._rdf_ is not None
+    @property
+    def has_nx(self):
+        return self._nx_ is not None
+    @property
+    def nx(self):
+        if self._nx_ is None:
+            self._materialize_nx_()
+        return self._nx_
+    @property
+    def rdf(self):
+        if self._rdf_ is None:
+            self._materialize_rdf_()
+        if self._pending_triples_:
+            with gc_paused():
+                self._rdf_.addN(
+                    (parent, predicate, child, self._rdf_)
+                    for predicate, pairs in self._pending_triples_
+                    for parent, child in pairs
+                )
+            self._pending_triples_ = []
+        return self._rdf_
+    def _materialize_nx_(self):
+        self._nx_ = DiGraph()
+        self._nx_.add_nodes_from(BNode('N{}'.format(node_id)) for node_id in range(self.node_id))
+        with gc_paused():
+            for predicate, subjects in self.subject_index.items():
+                attributes = {'label': predicate[len(NXRDF.NAMESPACE):]}
+                self._nx_.add_edges_from(
+                    (parent, child, attributes)
+                    for parent, children in subjects.items()
+                    for child in children
+                )
+    def _materialize_rdf_(self):
+        self._init_rdf_()
+        groups = defaultdict(list)
+        for parent, label, child in self._overwritten_edges_:
+            groups[label].append((parent, child))
+        for parent, child, label in self._nx_.edges(data='label'):
+            groups[label].append((parent, child))
+        self._overwritten_edges_ = []
+        with gc_paused():
+            for label, pairs in groups.items():
+                self._add_rdf_edges_(label, pairs)
     def add_edge(self, parent, label, child, **kwargs):
         assert isinstance(parent, BNode)
         assert isinstance(label, str)
         if not isinstance(child, (BNode, Literal)):
             assert child != '', 'Child node cannot be the empty string'
             child = self.add_literal(child)
-        self.rdf.add((parent, NXRDF.NAMESPACE[label], child))
-        self.nx.add_edge(parent, child, label=label, **kwargs)
+        if self._rdf_ is not None:
+            predicate = NXRDF.NAMESPACE[label]
+            self.rdf.add((parent, predicate, child))
+            objects = self.subject_index[predicate].setdefault(parent, [])
+            if child not in objects:
+                objects.append(child)
+                self.object_index[predicate].setdefault(child, []).append(parent)
+        if self._nx_ is not None:
+            if self._rdf_ is None:
+                self._record_overwritten_edges_(label, [(parent, child)])
+            self._nx_.add_edge(parent, child, label=label, **kwargs)
+    def add_edges(self, edges, **kwargs):
+        # bulk add_edge over an iterable of (parent, label, child) tuples;
+        # literals and predicates are created once per distinct value, and
+        # rdflib is only loaded when something first needs self.rdf
+        with gc_paused():
+            self._add_edges_(edges, **kwargs)
+    def _add_edges_(self, edges, **kwargs):
+        literals = {}
+        groups = {}
+        for parent, label, child in edges:
+            if not isinstance(child, (BNode, Literal)):
+                key = (type(child), child)
+                try:
+                    child = literals[key]
+                except KeyError:
+                    child = literals[key] = Literal(child)
+            try:
+                groups[label].append((parent, child))
+            except KeyError:
+                groups[label] = [(parent, child)]
+        assert all(isinstance(label, str) for label in groups)
+        assert all(isinstance(parent, BNode) for pairs in groups.values() for parent, _ in pairs)
+        assert (str, '') not in literals, 'Child node cannot be the empty string'
+        for label, pairs in groups.items():
+            if self._rdf_ is not None:
+                self._add_rdf_edges_(label, pairs)
+            if self._nx_ is not None:
+                if self._rdf_ is None:
+                    self._record_overwritten_edges_(label, pairs)
+                attributes = dict(kwargs, label=label)
+                self._nx_.add_edges_from((parent, child, attributes) for parent, child in pairs)
+    def _add_rdf_edges_(self, label, pairs):
+        predicate = NXRDF.NAMESPACE[label]
+        subject_index = self.subject_index[predicate]
+        object_index = self.object_index[predicate]
+        for parent, child in pairs:
+            objects = subject_index.setdefault(parent, [])
+            if child not in objects:
+                objects.append(child)
+                object_index.setdefault(child, []).append(parent)
+        self._pending_triples_.append((predicate, pairs))
+    def _record_overwritten_edges_(self, label, pairs):
+        successors = self._nx_.succ
+        for parent, child in pairs:
+            if parent in successors and child in successors[parent]:
+                old_label = successors[parent][child].get('label')
+                if old_label != label:
+                    self._overwritten_edges_.append((parent, old_label, child))
     def add_node(self, **kwargs):
         node = BNode('N{}'.format(self.node_id))
         self.node_id += 1
-        self.nx.add_node(node, **kwargs)
+        if self._nx_ is not None:
+            self._nx_.add_node(node, **kwargs)
         return node
+    def add_nodes(self, count, **kwargs):
+        nodes = [BNode('N{}'.format(node_id)) for node_id in range(self.node_id, self.node_id + count)]
+        self.node_id += count
+        if self._nx_ is not None:
+            self._nx_.add_nodes_from(nodes, **kwargs)
+        return nodes
     def add_literal(self, value, **kwargs):
         node = Literal(value)
-        self.nx.add_node(node, **kwargs)
+        if self._nx_ is not None:
+            self._nx_.add_node(node, **kwargs)
         return node
     def query(self, sqarql, **kwargs):
-        if 'initBindings' in kwargs:
-            keys = list(kwargs['initBindings'].keys())
-            for key in keys:
-                value = kwargs['initBindings'][key]
-                if isinstance(value, (int, float, str)):
-                    kwargs['initBindings'][key] = Literal(value)
-        return self.rdf.query(sqarql, **kwargs)
+        if self._rdf_ is None:
+            with span('insert'):
+                self._materialize_rdf_()
+        # the star plans are prepared once per query, so preparing a call is
+        # mostly converting its bindings and looking up its plan
+        with span('query_prepare'):
+            if 'initBindings' in kwargs:
+                keys = list(kwargs['initBindings'].keys())
+                for key in keys:
+                    value = kwargs['initBindings'][key]
+                    if isinstance(value, (int, float, str)):
+                        kwargs['initBindings'][key] = Literal(value)
+            plan = None
+            if set(kwargs) <= set(['initBindings']) and hasattr(sqarql, 'algebra'):
+                plan = StarQueryPlan.for_prepared_query(sqarql)
+        with span('query_execute'):
+            if plan is not None:
+                return plan.execute(self, kwargs.get('initBindings', {}))
+            result = self.rdf.query(sqarql, **kwargs)
+            if result.type == 'SELECT':
+                # rdflib evaluates the query as the result is iterated
+                result.bindings
+            return result
     def to_dot(self):
         return to_agraph(self.nx)
     def write_png(self, filename):
@@ -31,7 +31,7 @@ read -d '' 'JOB_SCRIPT' << EOF
 #
 # Change to y to make job rerunable
 #
-#PBS -r n
+#PBS -r y
 
 
 # PBS environment variables:
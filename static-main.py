@@ -9,13 +9,17 @@ def main(random_seed_index):
     # uncomment to simply print parameters
     #exp.function = (lambda parameters: parameters)
 
+    # rerunning the same index resumes from this manifest instead of starting over
+    checkpoint = 'static-{}.checkpoint'.format(random_seed_index)
+
     if random_seed_index < 49:
         exp.run_between(
             Namespace(random_seed_index=random_seed_index),
             Namespace(random_seed_index=random_seed_index+1),
+            checkpoint=checkpoint,
         )
     else:
-        exp.run_from(Namespace(random_seed_index=random_seed_index))
+        exp.run_from(Namespace(random_seed_index=random_seed_index), checkpoint=checkpoint)
 
 
 if __name__ == '__main__':
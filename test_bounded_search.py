@@ -0,0 +1,18 @@
+from chroma_wanderer import color_episodes
+from color import Color
+from episodes import EpisodeStore
+from experiments import batch_search, run_bounded_search, run_brute_force, run_search
+from permspace import Namespace
+
+def test_bounded_search_opposite_corner():
+    # every episode is exactly 3 * 255 from the target, which the scan never counts as a match
+    for fill, target in ((Color(0, 0, 0), Color(255, 255, 255)), (Color(255, 255, 255), Color(0, 0, 0))):
+        episode_graph = color_episodes(5 * [fill], 50, EpisodeStore())
+        parameters = Namespace(target_color=target, num_labels=50, num_neighbors=2)
+        min_time, min_color, total_episodes = run_brute_force(parameters, episode_graph)
+        assert (min_time, min_color) == (-1, None)
+        assert run_bounded_search(parameters, episode_graph, episode_graph.names)[:3] == (min_time, min_color, total_episodes)
+        assert batch_search(episode_graph, [target], 'brute-force', 50) == [(min_time, min_color, total_episodes)]
+        for algorithm in ('exact-heuristic', 'neighbor-heuristic'):
+            bounded_parameters = Namespace(search_mode='bounded', **parameters)
+            assert run_search(algorithm, bounded_parameters, episode_graph)[:3] == run_search(algorithm, parameters, episode_graph)[:3]
@@ -0,0 +1,79 @@
+from contextlib import nullcontext
+from functools import wraps
+from time import perf_counter, process_time
+
+# for each phase, its total wall time, CPU time, and number of calls; phases
+# are registered when their modules are imported, so that every run reports
+# the same phases
+PHASES = {}
+
+# phases currently being timed; a span inside a span of the same phase is not
+# timed again
+ACTIVE = set()
+
+ENABLED = False
+
+NULL_SPAN = nullcontext()
+
+def register(*names):
+    for name in names:
+        PHASES.setdefault(name, [0.0, 0.0, 0])
+
+def enable(enabled=True):
+    # returns whether timing was enabled before
+    global ENABLED
+    previous = ENABLED
+    ENABLED = enabled
+    return previous
+
+def reset():
+    for phase in PHASES.values():
+        phase[:] = [0.0, 0.0, 0]
+
+def snapshot():
+    # the totals since the last reset, as column names and values
+    result = {}
+    for name, (wall, cpu, calls) in sorted(PHASES.items()):
+        result['_{}_wall'.format(name)] = wall
+        result['_{}_cpu'.format(name)] = cpu
+        result['_{}_calls'.format(name)] = calls
+    return result
+
+class Span:
+    __slots__ = ('name', 'nested', 'wall', 'cpu')
+    def __init__(self, name):
+        assert name in PHASES, 'unregistered timing phase: {}'.format(name)
+        self.name = name
+    def __enter__(self):
+        self.nested = self.name in ACTIVE
+        if not self.nested:
+            ACTIVE.add(self.name)
+            self.wall = perf_counter()
+            self.cpu = process_time()
+        return self
+    def __exit__(self, *args):
+        if not self.nested:
+            phase = PHASES[self.name]
+            phase[0] += perf_counter() - self.wall
+            phase[1] += process_time() - self.cpu
+            phase[2] += 1
+            ACTIVE.discard(self.name)
+        return False
+
+def span(name):
+    # times the body of a with statement as the phase name; does nothing unless enabled
+    if not ENABLED:
+        return NULL_SPAN
+    return Span(name)
+
+def timed(name):
+    # times every call of the decorated function as the phase name
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            with Span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator